@@ -21,15 +21,21 @@ MongoDB backed stub for the Python datastore API.
 Transactions are unsupported.
 """
 
+import atexit
+import calendar
+import datetime
+import inspect
+import itertools
 import logging
+import Queue
+import string
 import sys
 import threading
+import time
 import types
-import re
-import random
+import uuid
 
 from google.appengine.api import apiproxy_stub
-from google.appengine.api import datastore
 from google.appengine.api import datastore_types
 from google.appengine.api import users
 from google.appengine.datastore import datastore_pb
@@ -38,8 +44,11 @@ from google.appengine.runtime import apiproxy_errors
 from google.appengine.datastore import entity_pb
 
 import pymongo
+import pymongo.errors
 from pymongo.connection import Connection
 from pymongo.binary import Binary
+from pymongo.bson import BSON
+from pymongo.son import SON
 
 datastore_pb.Query.__hash__ = lambda self: hash(self.Encode())
 
@@ -47,6 +56,784 @@ _MAXIMUM_RESULTS = 1000
 _MAX_QUERY_OFFSET = 1000
 _MAX_QUERY_COMPONENTS = 100
 
+# number of ids reserved from the counters collection at a time
+_ID_BLOCK_SIZE = 1000
+
+# collections used for the stub's own bookkeeping. App Engine reserves kind
+# names starting with "__", so these can't clash with an app's kinds.
+_COUNTERS_COLLECTION = "__counters__"
+_SCHEMA_COLLECTION = "__schema__"
+_METADATA_COLLECTION = "__metadata__"
+_COUNTS_COLLECTION = "__counts__"
+_INVALIDATIONS_COLLECTION = "__invalidations__"
+
+# bytes in the capped collection that invalidations are sent through, and how
+# often (in seconds) to check it for new ones
+_INVALIDATIONS_SIZE = 1024 * 1024
+_INVALIDATIONS_POLL_INTERVAL = 0.1
+
+# how long (in seconds) a stub trusts its copy of the list of built counts
+# before reading it again. counts that another process builds in the
+# meantime can miss this one's writes for that long.
+_BUILT_COUNTS_TTL = 1.0
+
+# tags recorded in the schema registry for stored values that aren't dicts
+# (dicts are tagged with their 'class' field)
+_VALUE_TAGS = {
+  types.StringType: 'string',
+  types.UnicodeType: 'string',
+  types.BooleanType: 'bool',
+  types.IntType: 'int',
+  types.LongType: 'int',
+  types.FloatType: 'float',
+  datetime.datetime: 'datetime',
+  Binary: 'blob',
+  types.NoneType: 'null',
+  }
+_UNORDERABLE_TAGS = frozenset(['text', 'blob'])
+
+# string meanings that we store as plain strings
+_PLAIN_STRING_MEANINGS = frozenset([entity_pb.Property.ATOM_LINK,
+                                    entity_pb.Property.GD_PHONENUMBER,
+                                    entity_pb.Property.GD_POSTALADDRESS])
+
+# default number of entries in each of the key encoding caches
+_KEY_CACHE_SIZE = 10000
+
+# default number of compiled query plans to keep
+_QUERY_PLAN_CACHE_SIZE = 1000
+
+# how long (in seconds) a query trusts a schema that lacks one of its
+# properties, or a kind with nothing stored, before reading it again
+_SCHEMA_MISS_TTL = 1.0
+
+# how many results a Next call returns when the client doesn't say. this is
+# the buffer size the SDK's query iterator asks for.
+_DEFAULT_BATCH_SIZE = 20
+
+# with read ahead on, the most results to buffer for one cursor, and for all
+# of the open cursors together
+_READ_AHEAD_RESULTS = 1000
+_READ_AHEAD_TOTAL = 10000
+
+# the most query cursors to keep open, and how long (in seconds) one can go
+# unused before it's closed. the server times its cursors out after ten
+# minutes.
+_MAX_OPEN_CURSORS = 1000
+_CURSOR_IDLE_TIMEOUT = 600
+
+# for kinds that are written behind, the most entities to hold before a Put
+# writes them out itself, and how often (in seconds) the background thread
+# writes out what's held
+_WRITE_BEHIND_SIZE = 1000
+_WRITE_BEHIND_INTERVAL = 1.0
+
+# Mongo operators for each datastore filter operator (None for equality)
+_FILTER_OPERATORS = {
+  datastore_pb.Query_Filter.LESS_THAN: '$lt',
+  datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL: '$lte',
+  datastore_pb.Query_Filter.GREATER_THAN: '$gt',
+  datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: '$gte',
+  datastore_pb.Query_Filter.EQUAL: None,
+  datastore_pb.Query_Filter.IN: '$in',
+  }
+
+def _is_internal_collection(name):
+  return name.startswith("__") or name.startswith("system.")
+
+class _KeyFormat1(object):
+  """The original key encoding.
+
+  Path elements are joined with "\\10", and numeric ids are stored as "\\t"
+  followed by their decimal string, so ids sort as strings (10 before 9).
+  """
+
+  version = 1
+
+  def id_for_pairs(self, pairs):
+    db_path = []
+    for (kind, id_or_name) in pairs:
+      db_path.append(kind)
+      if isinstance(id_or_name, basestring):
+        db_path.append(id_or_name)
+      else:
+        db_path.append("\t" + str(id_or_name))
+    return "\10".join(db_path)
+
+  def id_for_path(self, elements):
+    db_path = []
+    for elem in elements:
+      db_path.append(elem.type())
+      if elem.has_name():
+        db_path.append(elem.name())
+      else:
+        db_path.append("\t" + str(elem.id()))
+    return "\10".join(db_path)
+
+  def path_for_id(self, id):
+    parts = id.split("\10")
+    path = []
+    for i in range(0, len(parts), 2):
+      value = parts[i + 1]
+      if value.startswith("\t"):
+        value = int(value[1:])
+      path.append((parts[i], value))
+    return tuple(path)
+
+  def ancestor_bounds(self, prefix):
+    # descendant ids all fall in [prefix, prefix + "\11"), the $not drops
+    # the ids that extend the ancestor's last name or id without a separator
+    return {"$gte": prefix,
+            "$lt": prefix + "\11",
+            "$not": {"$gt": prefix, "$lt": prefix + "\10"}}
+
+_HEX_COMPLEMENT = string.maketrans("0123456789abcdef", "fedcba9876543210")
+
+class _KeyFormat2(object):
+  """A compact key encoding that sorts like App Engine keys.
+
+  Each path element is the kind, "\\2", then either "\\3" and an encoded
+  numeric id or "\\4" and the name, so ids sort before names. Elements are
+  joined with "\\1", which sorts before anything else, so parents sort right
+  before their children.
+
+  Numeric ids are encoded as a character giving the number of hex digits
+  followed by the digits, so they sort numerically. Negative ids get their
+  digits complemented and a lower length character, so that they sort before
+  positive ones.
+  """
+
+  version = 2
+
+  def __encode_id(self, id):
+    if id >= 0:
+      digits = "%x" % id
+      return chr(0x40 + len(digits)) + digits
+    digits = ("%x" % -id).translate(_HEX_COMPLEMENT)
+    return chr(0x3f - len(digits)) + digits
+
+  def __decode_id(self, value):
+    value = str(value)
+    if value[0] >= "@":
+      return int(value[1:], 16)
+    return -int(value[1:].translate(_HEX_COMPLEMENT), 16)
+
+  def id_for_pairs(self, pairs):
+    db_path = []
+    for (kind, id_or_name) in pairs:
+      if isinstance(id_or_name, basestring):
+        db_path.append(kind + "\2\4" + id_or_name)
+      else:
+        db_path.append(kind + "\2\3" + self.__encode_id(id_or_name))
+    return "\1".join(db_path)
+
+  def id_for_path(self, elements):
+    db_path = []
+    for elem in elements:
+      if elem.has_name():
+        db_path.append(elem.type() + "\2\4" + elem.name())
+      else:
+        db_path.append(elem.type() + "\2\3" + self.__encode_id(elem.id()))
+    return "\1".join(db_path)
+
+  def path_for_id(self, id):
+    path = []
+    for element in id.split("\1"):
+      (kind, value) = element.split("\2", 1)
+      if value[0] == "\3":
+        path.append((kind, self.__decode_id(value[1:])))
+      else:
+        path.append((kind, value[1:]))
+    return tuple(path)
+
+  def ancestor_bounds(self, prefix):
+    # nothing sorts between the ancestor and its first descendant
+    return {"$gte": prefix,
+            "$lt": prefix + "\2"}
+
+_KEY_FORMATS = {
+  1: _KeyFormat1(),
+  2: _KeyFormat2(),
+  }
+
+# the key format for new databases
+_LATEST_KEY_FORMAT = 2
+
+def _has_entities(database):
+  for name in database.collection_names():
+    if (not _is_internal_collection(name) and
+        database[name].find_one() is not None):
+      return True
+  return False
+
+def _stored_key_format(database):
+  """Returns the version of the key format used by database, or None if it
+  hasn't stored any entities yet.
+  """
+  document = database[_METADATA_COLLECTION].find_one({"_id": "key_format"})
+  if document is not None:
+    return document["version"]
+  if _has_entities(database):
+    # written before the key format was recorded
+    return 1
+  return None
+
+def _set_key_format(database, version):
+  database[_METADATA_COLLECTION].update({"_id": "key_format"},
+                                        {"_id": "key_format",
+                                         "version": version},
+                                        upsert=True)
+
+def _convert_keys_in_value(mongo_value, old, new):
+  if type(mongo_value) is not types.DictType:
+    return mongo_value
+  if mongo_value['class'] == 'key':
+    mongo_value['path'] = new.id_for_pairs(old.path_for_id(mongo_value['path']))
+  elif mongo_value['class'] == 'list':
+    for field in ('ascending_sort_key', 'descending_sort_key'):
+      mongo_value[field] = _convert_keys_in_value(mongo_value[field], old, new)
+    mongo_value['list'] = [_convert_keys_in_value(v, old, new)
+                           for v in mongo_value['list']]
+  return mongo_value
+
+def _utf8(value):
+  """Returns a string read back from the server as the utf-8 str that the
+  stub wrote, so that it can be compared with ids the stub makes.
+  """
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  return value
+
+def _count_value_key(value):
+  """Returns a string standing for a stored value in the ids of count
+  documents.
+
+  Equal values give the same string whether they were just encoded by the
+  stub or read back from the server (which hands back unicode strings,
+  dicts in any order and datetimes rounded to the millisecond).
+  """
+  if isinstance(value, dict):
+    items = ["%s:%s" % (_count_value_key(k), _count_value_key(v))
+             for (k, v) in value.items()]
+    items.sort()
+    return "{%s}" % ",".join(items)
+  if isinstance(value, list):
+    return "[%s]" % ",".join([_count_value_key(v) for v in value])
+  if isinstance(value, Binary):
+    return "b%r" % str(value)
+  if isinstance(value, str):
+    try:
+      value = value.decode("utf-8")
+    except UnicodeDecodeError:
+      pass
+  elif isinstance(value, bool):
+    return repr(value)
+  elif isinstance(value, (int, long)):
+    return str(value)
+  elif isinstance(value, datetime.datetime):
+    value = value.replace(microsecond=value.microsecond // 1000 * 1000)
+  return repr(value)
+
+def _counts_id(kind, names):
+  """Returns the id of the set of counts kept for kind by the values of
+  names. The ids of the count documents in the set all start with it.
+  """
+  return u"\0".join([kind] + list(names)) + u"\0\0"
+
+def _is_duplicate_key_error(error):
+  """Returns True if error is the server refusing a write because the _id
+  (or another unique key) is already taken.
+  """
+  if getattr(error, "code", None) in (11000, 11001):
+    return True
+  return "E11000" in str(error) or "E11001" in str(error)
+
+def _clamp_count(count, offset, limit):
+  count = max(0, count - offset)
+  if limit is not None:
+    count = min(count, limit)
+  return count
+
+# functions run when the process exits, to write out (or drop) what stubs
+# are holding. there's no taking a function back off atexit's list, so stubs
+# go through this one, which DatastoreMongoStub.Close() removes them from.
+_exit_handlers = set()
+
+def _run_exit_handlers():
+  for handler in list(_exit_handlers):
+    try:
+      handler()
+    except Exception:
+      logging.exception('writing out held entities at exit failed')
+
+atexit.register(_run_exit_handlers)
+
+def convert_key_format(database, version):
+  """Rewrites every key stored in database (ids and key properties) into key
+  format version.
+
+  Each collection is copied into a temporary collection with the converted
+  keys, which then replaces the original. Indexes are recreated. The app must
+  not be writing to database while this runs.
+
+  Args:
+    database: the pymongo Database holding the app's data
+    version: int, the key format to convert to
+  """
+  new = _KEY_FORMATS[version]
+  current = _stored_key_format(database)
+  if current is None or current == version:
+    _set_key_format(database, version)
+    return
+  old = _KEY_FORMATS[current]
+
+  for name in database.collection_names():
+    if _is_internal_collection(name):
+      continue
+
+    collection = database[name]
+    indexes = []
+    for (index_name, info) in collection.index_information().items():
+      if index_name == "_id_":
+        continue
+      if isinstance(info, types.DictType):
+        info = info["key"]
+      indexes.append(info)
+
+    temporary = database["__converting__" + name]
+    temporary.drop()
+    for document in collection.find():
+      document["_id"] = new.id_for_pairs(old.path_for_id(document["_id"]))
+      for (field, mongo_value) in document.items():
+        document[field] = _convert_keys_in_value(mongo_value, old, new)
+      temporary.insert(document)
+
+    collection.drop()
+    temporary.rename(name)
+    for index in indexes:
+      database[name].create_index(index)
+
+  # counts by key properties are kept under the old encoding. stubs rebuild
+  # the ones they keep when they start.
+  database[_COUNTS_COLLECTION].drop()
+  database[_METADATA_COLLECTION].remove({"_id": "counts"})
+
+  _set_key_format(database, version)
+
+class _LRUCache(object):
+  """A thread-safe map with a bounded size that evicts least recently used
+  entries first.
+
+  The size of an entry is given by sizeof(value), or is 1 if no sizeof
+  function is given. If max_idle is given, entries that haven't been used
+  for that many seconds are expired as well. on_evict(key, value) is called
+  for every entry that is evicted or expired, outside of the lock. Hit,
+  miss, eviction and expiration counts are kept for stats().
+  """
+
+  def __init__(self, max_size, sizeof=None, max_idle=None, on_evict=None):
+    self.__max_size = max_size
+    self.__sizeof = sizeof
+    self.__max_idle = max_idle
+    self.__on_evict = on_evict
+    self.__size = 0
+    self.__lock = threading.Lock()
+
+    # entries are [prev, next, key, value, size, last used] links in a
+    # circular list, with the least recently used entry right after the root
+    self.__entries = {}
+    self.__root = []
+    self.__root[:] = [self.__root, self.__root, None, None, 0, None]
+
+    self.__hits = 0
+    self.__misses = 0
+    self.__evictions = 0
+    self.__expirations = 0
+
+  def __unlink(self, link):
+    (prev, next) = link[0:2]
+    prev[1] = next
+    next[0] = prev
+
+  def __append(self, link):
+    last = self.__root[0]
+    link[0] = last
+    link[1] = self.__root
+    last[1] = link
+    self.__root[0] = link
+
+  def __now(self):
+    if self.__max_idle is None:
+      return None
+    return time.time()
+
+  def __expire(self, now, removed):
+    # the least recently used entries are the ones that have been idle the
+    # longest, so expired entries are all at the front of the list
+    if now is None:
+      return
+    oldest = self.__root[1]
+    while oldest is not self.__root and now - oldest[5] > self.__max_idle:
+      self.__unlink(oldest)
+      del self.__entries[oldest[2]]
+      self.__size -= oldest[4]
+      self.__expirations += 1
+      removed.append(oldest)
+      oldest = self.__root[1]
+
+  def __notify(self, removed):
+    if self.__on_evict is not None:
+      for link in removed:
+        self.__on_evict(link[2], link[3])
+
+  def get(self, key, default=None):
+    now = self.__now()
+    removed = []
+    self.__lock.acquire()
+    try:
+      self.__expire(now, removed)
+      link = self.__entries.get(key)
+      if link is None:
+        self.__misses += 1
+        return default
+      self.__hits += 1
+      self.__unlink(link)
+      self.__append(link)
+      link[5] = now
+      return link[3]
+    finally:
+      self.__lock.release()
+      self.__notify(removed)
+
+  def put(self, key, value):
+    if self.__sizeof is None:
+      size = 1
+    else:
+      size = self.__sizeof(value)
+
+    now = self.__now()
+    removed = []
+    self.__lock.acquire()
+    try:
+      self.__expire(now, removed)
+      link = self.__entries.pop(key, None)
+      if link is not None:
+        self.__unlink(link)
+        self.__size -= link[4]
+      if size > self.__max_size:
+        return
+
+      link = [None, None, key, value, size, now]
+      self.__append(link)
+      self.__entries[key] = link
+      self.__size += size
+
+      while self.__size > self.__max_size:
+        oldest = self.__root[1]
+        self.__unlink(oldest)
+        del self.__entries[oldest[2]]
+        self.__size -= oldest[4]
+        self.__evictions += 1
+        removed.append(oldest)
+    finally:
+      self.__lock.release()
+      self.__notify(removed)
+
+  def pop(self, key, default=None):
+    self.__lock.acquire()
+    try:
+      link = self.__entries.pop(key, None)
+      if link is None:
+        return default
+      self.__unlink(link)
+      self.__size -= link[4]
+      return link[3]
+    finally:
+      self.__lock.release()
+
+  def expire(self):
+    """Expires the entries that have been idle for too long."""
+    removed = []
+    self.__lock.acquire()
+    try:
+      self.__expire(self.__now(), removed)
+    finally:
+      self.__lock.release()
+      self.__notify(removed)
+
+  def values(self):
+    """Returns a list of the values, without counting as a use of them."""
+    self.__lock.acquire()
+    try:
+      return [link[3] for link in self.__entries.itervalues()]
+    finally:
+      self.__lock.release()
+
+  def clear(self):
+    self.__lock.acquire()
+    try:
+      self.__entries.clear()
+      self.__root[:] = [self.__root, self.__root, None, None, 0, None]
+      self.__size = 0
+    finally:
+      self.__lock.release()
+
+  def __len__(self):
+    return len(self.__entries)
+
+  def stats(self):
+    lookups = self.__hits + self.__misses
+    return {
+      'hits': self.__hits,
+      'misses': self.__misses,
+      'hit_rate': lookups and float(self.__hits) / lookups or 0.0,
+      'evictions': self.__evictions,
+      'expirations': self.__expirations,
+      'entries': len(self.__entries),
+      'size': self.__size,
+      }
+
+class _QueryPlan(object):
+  """The part of a query's translation that only depends on its shape.
+
+  bindings holds a (field, is_key, operator) tuple for each of the query's
+  filters, operator being None for equality. order is the Mongo sort order,
+  or None if the query can't match anything. complete is False if the plan
+  was compiled without knowing about all of the properties it uses.
+  """
+
+  def __init__(self, schema_version, complete, bindings, order):
+    self.schema_version = schema_version
+    self.complete = complete
+    self.bindings = bindings
+    self.order = order
+
+class _OpenQuery(object):
+  """A query that has been run but not yet read to the end.
+
+  Wraps the pymongo cursor along with the function that decodes its
+  documents into EntityProtos. Results that were read ahead of a Next call
+  (the first batch is fetched by RunQuery, later ones by the read ahead
+  thread) wait in buffered. The lock guards the cursor and the buffer, as
+  pymongo cursors can't be shared between threads.
+
+  If position is given, it's called with each document before it's decoded
+  to get the document's place in the query's sort order (the Mongo sort
+  order), and last_position is kept up to date with the place of the last
+  result fetched.
+  """
+
+  def __init__(self, cursor, decode, order=None, position=None,
+               last_position=None):
+    self.cursor = cursor
+    self.decode = decode
+    self.order = order
+    self.position = position
+    self.last_position = last_position
+    self.buffered = []
+    self.positions = []
+    self.exhausted = False
+    self.closed = False
+    self.read_ahead_pending = False
+    self.error = None
+    self.lock = threading.RLock()
+
+  def read(self, count):
+    """Reads up to count more results from the server into the buffer.
+
+    The documents are pulled off the cursor first and decoded together, so
+    a batch the size of count costs a single round trip.
+    """
+    if self.exhausted or self.closed:
+      return
+    documents = []
+    try:
+      for _ in xrange(count):
+        documents.append(self.cursor.next())
+    except StopIteration:
+      self.exhausted = True
+    finally:
+      # keep whatever arrived before an error
+      if self.position is not None:
+        position = self.position
+        self.positions.extend([position(document) for document in documents])
+      decode = self.decode
+      self.buffered.extend([decode(document) for document in documents])
+
+  def fetch(self, count):
+    """Returns a list of up to count results, reading more if needed.
+
+    Raises whatever error a read ahead ran into, once the results that were
+    read before it have been returned.
+    """
+    self.lock.acquire()
+    try:
+      if len(self.buffered) < count:
+        if self.error is not None and not self.buffered:
+          (error, self.error) = (self.error, None)
+          raise error
+        if self.error is None:
+          self.read(count - len(self.buffered))
+      results = self.buffered[:count]
+      del self.buffered[:count]
+      if self.position is not None and results:
+        self.last_position = self.positions[len(results) - 1]
+        del self.positions[:len(results)]
+      return results
+    finally:
+      self.lock.release()
+
+  def read_ahead(self, count, limit):
+    """Reads up to count results ahead, keeping at most limit buffered."""
+    self.lock.acquire()
+    try:
+      self.read_ahead_pending = False
+      count = min(count, limit - len(self.buffered))
+      if count > 0 and self.error is None:
+        try:
+          self.read(count)
+        except Exception, e:
+          # hand the error to the next fetch, which is what would have run
+          # into it without read ahead
+          self.error = e
+    finally:
+      self.lock.release()
+
+  def close(self):
+    """Drops any buffered results and kills the server side cursor. Nothing
+    more will be read.
+    """
+    self.lock.acquire()
+    try:
+      self.closed = True
+      self.buffered = []
+      self.positions = []
+      # older pymongos only kill the cursor once it's garbage collected
+      if hasattr(self.cursor, "close"):
+        self.cursor.close()
+    finally:
+      self.lock.release()
+
+  def more_results(self):
+    return (bool(self.buffered) or self.error is not None or
+            not (self.exhausted or self.closed))
+
+class MemoryInvalidationBus(object):
+  """Carries cache invalidations between stubs in the same process.
+
+  An invalidation bus lets stubs in different processes that share a
+  database keep their caches in step: each write is published as a list of
+  (collection, db id) pairs, and every subscriber is called with
+  callback(sender, keys). keys is None if the subscriber may have missed
+  invalidations and should drop everything it has cached. This one delivers
+  invalidations straight away, which makes it a stand-in for tests.
+  """
+
+  def __init__(self):
+    self.__subscribers = []
+    self.__lock = threading.Lock()
+
+  def subscribe(self, callback):
+    self.__lock.acquire()
+    try:
+      self.__subscribers.append(callback)
+    finally:
+      self.__lock.release()
+
+  def publish(self, sender, keys):
+    self.__lock.acquire()
+    try:
+      subscribers = list(self.__subscribers)
+    finally:
+      self.__lock.release()
+    for callback in subscribers:
+      callback(sender, keys)
+
+class MongoInvalidationBus(object):
+  """Carries cache invalidations between processes through a capped
+  collection.
+
+  Invalidations are inserted into the collection, and a thread in each
+  subscribing process tails it. See MemoryInvalidationBus for the interface.
+  """
+
+  def __init__(self, database, collection=_INVALIDATIONS_COLLECTION,
+               size=_INVALIDATIONS_SIZE,
+               poll_interval=_INVALIDATIONS_POLL_INTERVAL):
+    self.__collection = database[collection]
+    self.__poll_interval = poll_interval
+    self.__subscribers = []
+    self.__lock = threading.Lock()
+    self.__tailing = False
+    database.command(SON([("create", collection),
+                          ("capped", True),
+                          ("size", size)]),
+                     allowable_errors=["collection already exists"])
+
+  def subscribe(self, callback):
+    self.__lock.acquire()
+    try:
+      self.__subscribers.append(callback)
+      if self.__tailing:
+        return
+      self.__tailing = True
+    finally:
+      self.__lock.release()
+
+    # a tailable cursor dies if it reaches the end of an empty collection,
+    # and this marks where this process starts listening
+    marker = self.__collection.insert({"keys": []})
+    tail = threading.Thread(target=self.__tail, args=(marker,))
+    tail.setDaemon(True)
+    tail.start()
+
+  def publish(self, sender, keys):
+    self.__collection.insert({"sender": sender,
+                              "keys": [list(key) for key in keys]})
+
+  def __deliver(self, sender, keys):
+    self.__lock.acquire()
+    try:
+      subscribers = list(self.__subscribers)
+    finally:
+      self.__lock.release()
+    for callback in subscribers:
+      try:
+        callback(sender, keys)
+      except Exception:
+        logging.exception('delivering a cache invalidation failed')
+
+  def __tail(self, last):
+    # invalidations are read in insertion order, skipping those up to and
+    # including the last one seen
+    while True:
+      try:
+        cursor = self.__collection.find(tailable=True)
+        skipping = True
+        while True:
+          try:
+            document = cursor.next()
+          except StopIteration:
+            if skipping:
+              # the last one seen has been overwritten, so some
+              # invalidations may have been missed too
+              self.__deliver(None, None)
+              skipping = False
+            if not getattr(cursor, "alive", True):
+              break
+            time.sleep(self.__poll_interval)
+            continue
+          if skipping:
+            skipping = document["_id"] != last
+            continue
+          last = document["_id"]
+          if document["keys"]:
+            self.__deliver(document.get("sender"),
+                           [tuple(key) for key in document["keys"]])
+      except pymongo.errors.PyMongoError:
+        logging.exception('tailing cache invalidations failed')
+      time.sleep(self.__poll_interval)
+
 class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
   """Persistent stub for the Python datastore API, using MongoDB to persist.
 
@@ -57,7 +844,24 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
                app_id,
                datastore_file,
                require_indexes=False,
-               service_name='datastore_v3'):
+               service_name='datastore_v3',
+               key_cache_size=_KEY_CACHE_SIZE,
+               query_plan_cache_size=_QUERY_PLAN_CACHE_SIZE,
+               key_format=None,
+               read_ahead=False,
+               read_ahead_results=_READ_AHEAD_RESULTS,
+               read_ahead_total=_READ_AHEAD_TOTAL,
+               max_open_cursors=_MAX_OPEN_CURSORS,
+               cursor_idle_timeout=_CURSOR_IDLE_TIMEOUT,
+               counts=(),
+               entity_cache_size=0,
+               uncached_kinds=(),
+               invalidation_bus=None,
+               query_cache_size=0,
+               write_behind_kinds=(),
+               write_behind_size=_WRITE_BEHIND_SIZE,
+               write_behind_interval=_WRITE_BEHIND_INTERVAL,
+               write_behind_flush_on_exit=True):
     """Constructor.
 
     Initializes the datastore stub.
@@ -68,6 +872,51 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
       require_indexes: bool, default False.  If True, composite indexes must
           exist in index.yaml for queries that need them.
       service_name: Service name expected for all calls.
+      key_cache_size: int, the number of decoded keys and key paths to keep
+          cached.
+      query_plan_cache_size: int, the number of compiled query plans to keep
+          cached.
+      key_format: int, the version of the key encoding used for _id. Defaults
+          to the format the database was written with, or the latest format
+          for a new database. Databases can be moved between formats with
+          convert_key_format().
+      read_ahead: bool, default False. If True, after each Next call the
+          next batch of results is fetched and decoded by a background
+          thread, while the app works on the current one.
+      read_ahead_results: int, the most results to read ahead for a single
+          cursor.
+      read_ahead_total: int, the most results to read ahead for all of the
+          open cursors together.
+      max_open_cursors: int, the most query cursors to keep open. Once there
+          are more, the least recently used ones are closed.
+      cursor_idle_timeout: number, the seconds a query cursor can go unused
+          before it's closed. Idle cursors are closed by the next query.
+      counts: list of (kind, property names) pairs. For each pair, a count
+          of the kind's entities is kept for every combination of values of
+          the properties, and updated by each Put and Delete. Count answers
+          queries with one equality filter on each of the properties (and
+          no other filters) from these instead of scanning.
+      entity_cache_size: int, the most bytes of encoded entities to keep
+          cached for Get. Defaults to 0, which turns the cache off.
+      uncached_kinds: list of kinds whose entities and query results are
+          never cached.
+      invalidation_bus: a MongoInvalidationBus (or MemoryInvalidationBus),
+          to keep the caches of stubs in several processes in step. Writes
+          are published to it, and its invalidations are applied to this
+          stub's caches.
+      query_cache_size: int, the most bytes of encoded query results to keep
+          cached. Only queries with a limit are cached. Defaults to 0, which
+          turns the cache off.
+      write_behind_kinds: list of kinds whose entities are written behind:
+          Put holds them and returns straight away, and a background thread
+          writes them out in batches. Get, Delete and queries on one of the
+          kinds write its held entities out first.
+      write_behind_size: int, the most entities to hold. A Put that brings
+          the number up to this writes them all out itself.
+      write_behind_interval: number, the seconds between the background
+          thread's writes.
+      write_behind_flush_on_exit: bool, default True. If True held entities
+          are written out when the process exits, otherwise they're dropped.
     """
     super(DatastoreMongoStub, self).__init__(service_name)
 
@@ -79,6 +928,19 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
     # TODO should be a way to configure the connection
     self.__db = Connection()[app_id]
 
+    stored_key_format = _stored_key_format(self.__db)
+    if key_format is None:
+      key_format = stored_key_format or _LATEST_KEY_FORMAT
+    if key_format not in _KEY_FORMATS:
+      raise ValueError("unknown key format %r" % key_format)
+    if stored_key_format is None:
+      _set_key_format(self.__db, key_format)
+    elif stored_key_format != key_format:
+      raise ValueError("database %r uses key format %d, convert it with "
+                       "convert_key_format() to use key format %d" %
+                       (app_id, stored_key_format, key_format))
+    self.__key_format = _KEY_FORMATS[key_format]
+
     # NOTE our query history gets reset each time the server restarts...
     # should this be fixed?
     self.__query_history = {}
@@ -87,9 +949,104 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
     self.__indexes = {}
     self.__index_lock = threading.Lock()
 
+    # open query cursors, keyed by the cursor number handed to the client
     self.__cursor_lock = threading.Lock()
     self.__next_cursor = 1
-    self.__queries = {}
+    self.__queries = _LRUCache(max_open_cursors,
+                               max_idle=cursor_idle_timeout,
+                               on_evict=self.__close_cursor)
+
+    self.__read_ahead_results = read_ahead_results
+    self.__read_ahead_total = read_ahead_total
+    self.__read_ahead_queue = None
+    if read_ahead:
+      self.__read_ahead_queue = Queue.Queue()
+      worker = threading.Thread(target=self.__read_ahead_worker)
+      worker.setDaemon(True)
+      worker.start()
+
+    self.__id_lock = threading.Lock()
+    self.__id_blocks = {}
+
+    # decoded keys and paths, keyed by the db id
+    self.__key_cache = _LRUCache(key_cache_size)
+    self.__path_cache = _LRUCache(key_cache_size)
+
+    # property name -> set of value tags, for each kind
+    self.__schemas = {}
+    self.__schema_versions = {}
+    self.__schema_lock = threading.Lock()
+    # kind -> when a load last came up without something a query needed
+    self.__schema_misses = {}
+
+    # compiled query plans, keyed by query shape
+    self.__query_plans = _LRUCache(query_plan_cache_size)
+
+    # encoded EntityProtos, keyed by (collection, db id). the generation
+    # goes up with every write, so a Get that raced with one knows not to
+    # cache what it read. the lock keeps a write from landing between a Get
+    # checking the generation and caching.
+    self.__entity_cache = None
+    if entity_cache_size > 0:
+      self.__entity_cache = _LRUCache(entity_cache_size, sizeof=len)
+    self.__entity_cache_generation = 0
+    self.__entity_cache_lock = threading.Lock()
+    self.__uncached_kinds = frozenset([unicode(kind) for kind in uncached_kinds])
+
+    # (kind version, encoded EntityProtos), keyed by encoded query. each kind
+    # gets a new version from the counter when it's written to, and so does
+    # the epoch when another process may have written to anything. cached
+    # results are only good while both are the same. hits and misses are
+    # also counted by query shape.
+    self.__query_cache = None
+    if query_cache_size > 0:
+      self.__query_cache = _LRUCache(query_cache_size,
+                                     sizeof=self.__cached_results_size)
+    self.__write_counter = itertools.count(1)
+    self.__kind_versions = {}
+    self.__versions_epoch = 0
+    self.__query_cache_shapes = {}
+    self.__query_cache_lock = threading.Lock()
+
+    # entities held back from being written, as (ids in order put, {id:
+    # document}, set of fresh ids) for each collection. collections in
+    # __flushing have entities on their way to the server. a flush of one
+    # of them waits for that to finish, so a read that flushes can't miss
+    # them and batches for a collection are written in order.
+    self.__write_behind_kinds = frozenset([unicode(kind)
+                                           for kind in write_behind_kinds])
+    self.__write_behind_size = write_behind_size
+    self.__held = {}
+    self.__held_count = 0
+    self.__held_lock = threading.Lock()
+    self.__flushing = set()
+    self.__flushed = threading.Condition(self.__held_lock)
+    self.__closed = threading.Event()
+    self.__exit_handler = None
+    if self.__write_behind_kinds:
+      flusher = threading.Thread(target=self.__write_behind_flusher,
+                                 args=(write_behind_interval,))
+      flusher.setDaemon(True)
+      flusher.start()
+      if write_behind_flush_on_exit:
+        self.__exit_handler = self.Flush
+      else:
+        self.__exit_handler = self.__drop_held
+      _exit_handlers.add(self.__exit_handler)
+
+    # the current thread's request scope, see BeginRequest()
+    self.__request_scopes = threading.local()
+
+    # tells this stub's invalidations apart from other processes'
+    self.__invalidation_bus = invalidation_bus
+    self.__bus_id = uuid.uuid4().hex
+    if invalidation_bus is not None and (self.__entity_cache is not None or
+                                         self.__query_cache is not None):
+      invalidation_bus.subscribe(self.__receive_invalidations)
+
+    self.__init_value_converters()
+    self.__init_property_fillers()
+    self.__init_counts(counts)
 
   def MakeSyncCall(self, service, call, request, response):
     """ The main RPC entry point. service must be 'datastore_v3'. So far, the
@@ -103,155 +1060,1069 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
     explanation = []
     assert response.IsInitialized(explanation), explanation
 
+  def BeginRequest(self):
+    """Opens a request scope for the current thread.
+
+    Until EndRequest() is called, the first Get of each key reads it as
+    usual and later Gets of the key are answered with the same entity (or
+    lack of one) without going to the database. Puts and Deletes from the
+    thread still write straight through, and are seen by its later Gets.
+    """
+    self.__request_scopes.entities = {}
+
+  def EndRequest(self):
+    """Closes the current thread's request scope, dropping the entities it
+    holds.
+    """
+    self.__request_scopes.entities = None
+
+  def Flush(self, collections=None):
+    """Writes out the entities held for kinds that are written behind, or
+    just those of the kinds in collections.
+    """
+    if not self.__held and not self.__flushing:
+      return
+
+    self.__held_lock.acquire()
+    try:
+      if collections is None:
+        collections = set(self.__held.keys()) | self.__flushing
+      else:
+        collections = set([collection for collection in collections
+                           if collection in self.__held or
+                           collection in self.__flushing])
+      if not collections:
+        return
+      while collections & self.__flushing:
+        self.__flushed.wait()
+
+      batches = []
+      for collection in collections:
+        if collection in self.__held:
+          (order, held, fresh) = self.__held.pop(collection)
+          self.__held_count -= len(order)
+          batches.append((collection, [held[id] for id in order], fresh))
+          self.__flushing.add(collection)
+    finally:
+      self.__held_lock.release()
+
+    try:
+      for (collection, documents, fresh) in batches:
+        (count, error) = self.__write_documents(collection, documents, fresh)
+        if error is not None:
+          # whoever put these has long since been told they were written
+          logging.error('writing held %r entities failed, dropped %d of '
+                        'them: %s', collection, len(documents) - count, error)
+    finally:
+      self.__held_lock.acquire()
+      try:
+        for (collection, _, _) in batches:
+          self.__flushing.discard(collection)
+        self.__flushed.notifyAll()
+      finally:
+        self.__held_lock.release()
+
+  def Close(self):
+    """Stops the stub's background threads and closes its query cursors.
+    Held entities are written out (or dropped) as they would be when the
+    process exits, and the stub can't be used afterwards.
+    """
+    if self.__closed.isSet():
+      return
+    self.__closed.set()
+    if self.__exit_handler is not None:
+      _exit_handlers.discard(self.__exit_handler)
+      self.__exit_handler()
+    if self.__read_ahead_queue is not None:
+      self.__read_ahead_queue.put(None)
+    for open_query in self.__queries.values():
+      open_query.close()
+    self.__queries.clear()
+
+  def __write_behind_flusher(self, interval):
+    while True:
+      self.__closed.wait(interval)
+      if self.__closed.isSet():
+        return
+      try:
+        self.Flush()
+      except Exception:
+        logging.exception('writing held entities failed')
+
+  def __drop_held(self):
+    if self.__held_count:
+      logging.warning('dropping %d held entities that were never written',
+                      self.__held_count)
+
+  def __hold_documents(self, collection, documents, fresh):
+    self.__held_lock.acquire()
+    try:
+      (order, held, held_fresh) = self.__held.setdefault(collection,
+                                                         ([], {}, set()))
+      for document in documents:
+        id = document["_id"]
+        # an id that was fresh when first held still isn't in the collection
+        if id not in held:
+          order.append(id)
+          self.__held_count += 1
+          if id in fresh:
+            held_fresh.add(id)
+        held[id] = document
+      full = self.__held_count >= self.__write_behind_size
+    finally:
+      self.__held_lock.release()
+    if full:
+      self.Flush()
+
   def QueryHistory(self):
     """Returns a dict that maps Query PBs to times they've been run.
     """
     return dict((pb, times) for pb, times in self.__query_history.items()
                 if pb.app() == self.__app_id)
 
+  def CacheStats(self):
+    """Returns a dict that maps the name of each of the stub's caches to a dict
+    of statistics for it.
+    """
+    stats = {
+      'keys': self.__key_cache.stats(),
+      'paths': self.__path_cache.stats(),
+      'query_plans': self.__query_plans.stats(),
+      }
+    if self.__entity_cache is not None:
+      stats['entities'] = self.__entity_cache.stats()
+    if self.__query_cache is not None:
+      stats['queries'] = self.__query_cache.stats()
+    return stats
+
+  def QueryCacheStats(self):
+    """Returns a dict that maps query shapes to a dict of query cache hits,
+    misses and the hit rate for queries of that shape. A shape is a tuple of
+    the kind, whether there's an ancestor, the (property, operator) of each
+    filter and the (property, direction) of each sort order.
+    """
+    self.__query_cache_lock.acquire()
+    try:
+      stats = {}
+      for (shape, (hits, misses)) in self.__query_cache_shapes.iteritems():
+        stats[shape] = {
+          'hits': hits,
+          'misses': misses,
+          'hit_rate': float(hits) / (hits + misses),
+          }
+      return stats
+    finally:
+      self.__query_cache_lock.release()
+
+  def CursorStats(self):
+    """Returns a dict of statistics for the stub's query cursors: how many
+    are open, how many have been opened in total, and how many were closed
+    early, either to make room for new ones (evictions) or because they sat
+    unused for too long (expirations).
+    """
+    stats = self.__queries.stats()
+    return {
+      'open': stats['entries'],
+      'opened': self.__next_cursor - 1,
+      'evictions': stats['evictions'],
+      'expirations': stats['expirations'],
+      }
+
   def __collection_for_key(self, key):
     return key.path().element(-1).type()
 
+  def __id_for_path(self, elements):
+    return self.__key_format.id_for_path(elements)
+
   def __id_for_key(self, key):
-    db_path = []
-    def add_element_to_db_path(elem):
-      db_path.append(elem.type())
-      if elem.has_name():
-        db_path.append(elem.name())
-      else:
-        db_path.append("\t" + str(elem.id()))
-    for elem in key.path().element_list():
-      add_element_to_db_path(elem)
-    return "\10".join(db_path)
+    return self.__id_for_path(key.path().element_list())
+
+  def __path_for_id(self, id):
+    """Splits a db id into a tuple of (kind, id or name) pairs.
+    """
+    path = self.__path_cache.get(id)
+    if path is None:
+      path = self.__key_format.path_for_id(id)
+      self.__path_cache.put(id, path)
+    return path
 
   def __key_for_id(self, id):
-    def from_db(value):
-      if value.startswith("\t"):
-        return int(value[1:])
-      return value
-    return datastore_types.Key.from_path(*[from_db(a) for a in id.split("\10")])
+    key = self.__key_cache.get(id)
+    if key is None:
+      flat_path = []
+      for pair in self.__path_for_id(id):
+        flat_path.extend(pair)
+      key = datastore_types.Key.from_path(*flat_path)
+      self.__key_cache.put(id, key)
+    return key
+
+  def __fill_path(self, add_element, id):
+    """Adds the path elements for a db id using the add_element PB method.
+    """
+    for (kind, id_or_name) in self.__path_for_id(id):
+      elem = add_element()
+      elem.set_type(kind.encode('utf-8'))
+      if isinstance(id_or_name, basestring):
+        elem.set_name(id_or_name.encode('utf-8'))
+      else:
+        elem.set_id(id_or_name)
+
+  def __encode_rating(self, value):
+    return {
+      'class': 'rating',
+      'rating': int(value),
+      }
+
+  def __encode_category(self, value):
+    return {
+      'class': 'category',
+      'category': str(value),
+      }
+
+  def __encode_key(self, value):
+    # _ToPb() would copy the reference, which we only need to read from
+    return {
+      'class': 'key',
+      'path': self.__id_for_key(value._Key__reference),
+      }
+
+  def __encode_list(self, value):
+    list_for_db = [self.__create_mongo_value_for_value(v) for v in value]
+    sorted_list = sorted(value)
+    return {
+      'class': 'list',
+      'list': list_for_db,
+      'ascending_sort_key': self.__create_mongo_value_for_value(sorted_list[0]),
+      'descending_sort_key': self.__create_mongo_value_for_value(sorted_list[-1]),
+      }
+
+  def __encode_user(self, value):
+    return {
+      'class': 'user',
+      'email': value.email(),
+      }
+
+  def __encode_text(self, value):
+    return {
+      'class': 'text',
+      'string': unicode(value),
+      }
+
+  def __encode_blob(self, value):
+    return Binary(value)
+
+  def __encode_bytes(self, value):
+    return {
+      'class': 'bytes',
+      'value': Binary(value)
+      }
+
+  def __encode_im(self, value):
+    return {
+      'class': 'im',
+      'protocol': value.protocol,
+      'address': value.address,
+      }
+
+  def __encode_geopt(self, value):
+    return {
+      'class': 'geopt',
+      'lat': value.lat,
+      'lon': value.lon,
+      }
+
+  def __encode_email(self, value):
+    return {
+      'class': 'email',
+      'value': value,
+      }
+
+  def __encode_blobkey(self, value):
+    return {
+      'class': 'blobkey',
+      'value': value,
+      }
+
+  def __decode_rating(self, mongo_value):
+    return datastore_types.Rating(int(mongo_value["rating"]))
+
+  def __decode_category(self, mongo_value):
+    return datastore_types.Category(mongo_value["category"])
+
+  def __decode_key(self, mongo_value):
+    return self.__key_for_id(mongo_value['path'])
+
+  def __decode_list(self, mongo_value):
+    return [self.__create_value_for_mongo_value(v) for v in mongo_value['list']]
+
+  def __decode_user(self, mongo_value):
+    return users.User(email=mongo_value["email"])
+
+  def __decode_text(self, mongo_value):
+    return datastore_types.Text(mongo_value['string'])
+
+  def __decode_im(self, mongo_value):
+    return datastore_types.IM(mongo_value['protocol'], mongo_value['address'])
+
+  def __decode_geopt(self, mongo_value):
+    return datastore_types.GeoPt(mongo_value['lat'], mongo_value['lon'])
+
+  def __decode_email(self, mongo_value):
+    return datastore_types.Email(mongo_value['value'])
+
+  def __decode_bytes(self, mongo_value):
+    return datastore_types.ByteString(mongo_value['value'])
+
+  def __decode_blobkey(self, mongo_value):
+    return datastore_types.BlobKey(mongo_value['value'])
+
+  def __init_value_converters(self):
+    # encoders by exact type. types that aren't in here are looked up along
+    # their MRO the first time they're seen, and the result is cached in
+    # __encoder_cache (None meaning the value is stored as is).
+    self.__encoders = {
+      datastore_types.Rating: self.__encode_rating,
+      datastore_types.Category: self.__encode_category,
+      datastore_types.Key: self.__encode_key,
+      types.ListType: self.__encode_list,
+      users.User: self.__encode_user,
+      datastore_types.Text: self.__encode_text,
+      datastore_types.Blob: self.__encode_blob,
+      datastore_types.ByteString: self.__encode_bytes,
+      datastore_types.IM: self.__encode_im,
+      datastore_types.GeoPt: self.__encode_geopt,
+      datastore_types.Email: self.__encode_email,
+      datastore_types.BlobKey: self.__encode_blobkey,
+      }
+    self.__encoder_cache = dict(self.__encoders)
+
+    # decoders by the 'class' field of the stored value
+    self.__decoders = {
+      'rating': self.__decode_rating,
+      'category': self.__decode_category,
+      'key': self.__decode_key,
+      'list': self.__decode_list,
+      'user': self.__decode_user,
+      'text': self.__decode_text,
+      'im': self.__decode_im,
+      'geopt': self.__decode_geopt,
+      'email': self.__decode_email,
+      'bytes': self.__decode_bytes,
+      'blobkey': self.__decode_blobkey,
+      }
+
+    # types added by RegisterValueType, which the direct Property PB
+    # converters have to leave to the tables above
+    self.__registered_types = ()
+
+  def RegisterValueType(self, value_type, class_name, to_mongo, from_mongo):
+    """Registers converters for storing values of an additional type.
+
+    Values of value_type (or a subclass of it) are stored as a dict holding
+    the fields returned by to_mongo(value), plus a 'class' field set to
+    class_name. Stored values with that 'class' are passed to
+    from_mongo(mongo_value) when they are read back.
+
+    Args:
+      value_type: type (or class) of the values to convert
+      class_name: string, must not be used by any other registered type
+      to_mongo: function taking a value and returning a dict of fields
+      from_mongo: function taking the stored dict and returning a value
+    """
+    if class_name in self.__decoders:
+      raise ValueError("a value type is already registered for class %r" %
+                       class_name)
+
+    def encode(value):
+      mongo_value = to_mongo(value)
+      mongo_value['class'] = class_name
+      return mongo_value
+
+    def fill(prop, pbval, mongo_value):
+      value = from_mongo(mongo_value)
+      multiple = prop.multiple()
+      prop.CopyFrom(datastore_types.ToPropertyPb(prop.name().decode('utf-8'),
+                                                 value))
+      prop.set_multiple(multiple)
+      return isinstance(value, datastore_types._RAW_PROPERTY_TYPES)
+
+    self.__encoders[value_type] = encode
+    self.__encoder_cache = dict(self.__encoders)
+    self.__decoders[class_name] = from_mongo
+    self.__class_fillers[class_name] = fill
+    self.__registered_types += (value_type,)
+
+  def __encoder_for_type(self, value_type):
+    encoder = None
+    for base in inspect.getmro(value_type):
+      if base in self.__encoders:
+        encoder = self.__encoders[base]
+        break
+    self.__encoder_cache[value_type] = encoder
+    return encoder
 
   def __create_mongo_value_for_value(self, value):
-    if isinstance(value, datastore_types.Rating):
-      return {
-        'class': 'rating',
-        'rating': int(value),
-        }
-    if isinstance(value, datastore_types.Category):
-      return {
-        'class': 'category',
-        'category': str(value),
-        }
-    if isinstance(value, datastore_types.Key):
+    value_type = value.__class__
+    try:
+      encoder = self.__encoder_cache[value_type]
+    except KeyError:
+      encoder = self.__encoder_for_type(value_type)
+    if encoder is None:
+      return value
+    return encoder(value)
+
+  def __create_value_for_mongo_value(self, mongo_value):
+    if isinstance(mongo_value, Binary):
+      return datastore_types.Blob(str(mongo_value))
+    if isinstance(mongo_value, types.DictType):
+      decoder = self.__decoders.get(mongo_value['class'])
+      if decoder is not None:
+        return decoder(mongo_value)
+    return mongo_value
+
+  def __mongo_value_for_property(self, prop):
+    """Converts a single-valued Property PB straight to its Mongo value.
+
+    Gives the same result as running FromPropertyPb through
+    __create_mongo_value_for_value, but skips building the intermediate
+    datastore_types value for all of the common cases (unless value types
+    have been registered, which could claim any of them).
+    """
+    if self.__registered_types:
+      value = datastore_types.FromPropertyPb(prop)
+      if isinstance(value, self.__registered_types):
+        return self.__create_mongo_value_for_value(value)
+
+    pbval = prop.value()
+    meaning = prop.meaning()
+    has_meaning = prop.has_meaning()
+
+    if pbval.has_stringvalue():
+      value = pbval.stringvalue()
+      if meaning == entity_pb.Property.BLOB:
+        return Binary(value)
+      if meaning == entity_pb.Property.BYTESTRING:
+        return {
+          'class': 'bytes',
+          'value': Binary(value),
+          }
+      value = value.decode('utf-8')
+      if not has_meaning or meaning in _PLAIN_STRING_MEANINGS:
+        return value
+      if meaning == entity_pb.Property.TEXT:
+        return {
+          'class': 'text',
+          'string': value,
+          }
+      if meaning == entity_pb.Property.ATOM_CATEGORY:
+        return {
+          'class': 'category',
+          'category': str(value),
+          }
+      if meaning == entity_pb.Property.GD_EMAIL:
+        return {
+          'class': 'email',
+          'value': value,
+          }
+      if meaning == entity_pb.Property.GD_IM:
+        (protocol, address) = value.split(' ', 1)
+        return {
+          'class': 'im',
+          'protocol': protocol,
+          'address': address,
+          }
+      if meaning == entity_pb.Property.BLOBKEY:
+        return {
+          'class': 'blobkey',
+          'value': value,
+          }
+    elif pbval.has_int64value():
+      value = long(pbval.int64value())
+      if not has_meaning:
+        return value
+      if meaning == entity_pb.Property.GD_RATING:
+        return {
+          'class': 'rating',
+          'rating': int(value),
+          }
+      if meaning == entity_pb.Property.GD_WHEN:
+        return datastore_types._PROPERTY_CONVERSIONS[meaning](value)
+    elif has_meaning:
+      if pbval.has_pointvalue() and meaning == entity_pb.Property.GEORSS_POINT:
+        return {
+          'class': 'geopt',
+          'lat': pbval.pointvalue().x(),
+          'lon': pbval.pointvalue().y(),
+          }
+    elif pbval.has_booleanvalue():
+      return bool(pbval.booleanvalue())
+    elif pbval.has_doublevalue():
+      return pbval.doublevalue()
+    elif pbval.has_referencevalue():
       return {
         'class': 'key',
-        'path': self.__id_for_key(value._ToPb()),
-        }
-    if isinstance(value, types.ListType):
-      list_for_db = [self.__create_mongo_value_for_value(v) for v in value]
-      sorted_list = sorted(value)
-      return {
-        'class': 'list',
-        'list': list_for_db,
-        'ascending_sort_key': self.__create_mongo_value_for_value(sorted_list[0]),
-        'descending_sort_key': self.__create_mongo_value_for_value(sorted_list[-1]),
+        'path': self.__id_for_path(pbval.referencevalue().pathelement_list()),
         }
-    if isinstance(value, users.User):
+    elif pbval.has_uservalue():
       return {
         'class': 'user',
-        'email': value.email(),
-        }
-    if isinstance(value, datastore_types.Text):
-      return {
-        'class': 'text',
-        'string': unicode(value),
-        }
-    if isinstance(value, datastore_types.Blob):
-      return Binary(value)
-    if isinstance(value, datastore_types.ByteString):
-      return {
-        'class': 'bytes',
-        'value': Binary(value)
-        }
-    if isinstance(value, datastore_types.IM):
-      return {
-        'class': 'im',
-        'protocol': value.protocol,
-        'address': value.address,
-        }
-    if isinstance(value, datastore_types.GeoPt):
-      return {
-        'class': 'geopt',
-        'lat': value.lat,
-        'lon': value.lon,
-        }
-    if isinstance(value, datastore_types.Email):
-      return {
-        'class': 'email',
-        'value': value,
-        }
-    if isinstance(value, datastore_types.BlobKey):
-      return {
-        'class': 'blobkey',
-        'value': value,
+        'email': pbval.uservalue().email().decode('utf-8'),
         }
-    return value
 
-  def __create_value_for_mongo_value(self, mongo_value):
-    if isinstance(mongo_value, Binary):
-      return datastore_types.Blob(str(mongo_value))
-    if isinstance(mongo_value, types.DictType):
-      if mongo_value['class'] == 'rating':
-        return datastore_types.Rating(int(mongo_value["rating"]))
-      if mongo_value['class'] == 'category':
-        return datastore_types.Category(mongo_value["category"])
-      if mongo_value['class'] == 'key':
-        return self.__key_for_id(mongo_value['path'])
-      if mongo_value['class'] == 'list':
-        return [self.__create_value_for_mongo_value(v) for v in mongo_value['list']]
-      if mongo_value['class'] == 'user':
-        return users.User(email=mongo_value["email"])
-      if mongo_value['class'] == 'text':
-        return datastore_types.Text(mongo_value['string'])
-      if mongo_value['class'] == 'im':
-        return datastore_types.IM(mongo_value['protocol'], mongo_value['address'])
-      if mongo_value['class'] == 'geopt':
-        return datastore_types.GeoPt(mongo_value['lat'], mongo_value['lon'])
-      if mongo_value['class'] == 'email':
-        return datastore_types.Email(mongo_value['value'])
-      if mongo_value['class'] == 'bytes':
-        return datastore_types.ByteString(mongo_value['value'])
-      if mongo_value['class'] == 'blobkey':
-        return datastore_types.BlobKey(mongo_value['value'])
-    return mongo_value
+    # anything unusual goes the long way around
+    return self.__create_mongo_value_for_value(datastore_types.FromPropertyPb(prop))
 
   def __mongo_document_for_entity(self, entity):
     document = {}
     document["_id"] = self.__id_for_key(entity.key())
 
-    entity = datastore.Entity._FromPb(entity)
-    for (k, v) in entity.iteritems():
-      v = self.__create_mongo_value_for_value(v)
-      document[k] = v
+    multiple = {}
+    for prop_list in (entity.property_list(), entity.raw_property_list()):
+      for prop in prop_list:
+        name = prop.name().decode('utf-8')
+        if prop.multiple():
+          multiple.setdefault(name, []).append(prop)
+        else:
+          document[name] = self.__mongo_value_for_property(prop)
+
+    # lists store sort keys chosen by comparing the Python values, so those
+    # still need to be built
+    for (name, props) in multiple.iteritems():
+      values = [datastore_types.FromPropertyPb(prop) for prop in props]
+      document[name] = self.__create_mongo_value_for_value(values)
 
     return document
 
+  def __fill_string(self, prop, pbval, mongo_value):
+    pbval.set_stringvalue(mongo_value)
+    return False
+
+  def __fill_unicode(self, prop, pbval, mongo_value):
+    pbval.set_stringvalue(mongo_value.encode('utf-8'))
+    return False
+
+  def __fill_bool(self, prop, pbval, mongo_value):
+    pbval.set_booleanvalue(mongo_value)
+    return False
+
+  def __fill_int(self, prop, pbval, mongo_value):
+    pbval.set_int64value(mongo_value)
+    return False
+
+  def __fill_float(self, prop, pbval, mongo_value):
+    pbval.set_doublevalue(mongo_value)
+    return False
+
+  def __fill_datetime(self, prop, pbval, mongo_value):
+    prop.set_meaning(entity_pb.Property.GD_WHEN)
+    pbval.set_int64value(
+      calendar.timegm(mongo_value.utctimetuple()) * 1000000L +
+      mongo_value.microsecond)
+    return False
+
+  def __fill_blob(self, prop, pbval, mongo_value):
+    prop.set_meaning(entity_pb.Property.BLOB)
+    pbval.set_stringvalue(str(mongo_value))
+    return True
+
+  def __fill_none(self, prop, pbval, mongo_value):
+    return False
+
+  def __fill_text(self, prop, pbval, mongo_value):
+    prop.set_meaning(entity_pb.Property.TEXT)
+    pbval.set_stringvalue(mongo_value['string'].encode('utf-8'))
+    return True
+
+  def __fill_key(self, prop, pbval, mongo_value):
+    ref = pbval.mutable_referencevalue()
+    ref.set_app(self.__app_id)
+    self.__fill_path(ref.add_pathelement, mongo_value['path'])
+    return False
+
+  def __fill_rating(self, prop, pbval, mongo_value):
+    prop.set_meaning(entity_pb.Property.GD_RATING)
+    pbval.set_int64value(mongo_value['rating'])
+    return False
+
+  def __fill_category(self, prop, pbval, mongo_value):
+    prop.set_meaning(entity_pb.Property.ATOM_CATEGORY)
+    pbval.set_stringvalue(mongo_value['category'].encode('utf-8'))
+    return False
+
+  def __fill_email(self, prop, pbval, mongo_value):
+    prop.set_meaning(entity_pb.Property.GD_EMAIL)
+    pbval.set_stringvalue(mongo_value['value'].encode('utf-8'))
+    return False
+
+  def __fill_geopt(self, prop, pbval, mongo_value):
+    prop.set_meaning(entity_pb.Property.GEORSS_POINT)
+    pbval.mutable_pointvalue().set_x(mongo_value['lat'])
+    pbval.mutable_pointvalue().set_y(mongo_value['lon'])
+    return False
+
+  def __fill_im(self, prop, pbval, mongo_value):
+    prop.set_meaning(entity_pb.Property.GD_IM)
+    pbval.set_stringvalue(
+      (u"%s %s" % (mongo_value['protocol'], mongo_value['address'])).encode('utf-8'))
+    return False
+
+  def __fill_bytes(self, prop, pbval, mongo_value):
+    prop.set_meaning(entity_pb.Property.BYTESTRING)
+    pbval.set_stringvalue(str(mongo_value['value']))
+    return False
+
+  def __fill_blobkey(self, prop, pbval, mongo_value):
+    prop.set_meaning(entity_pb.Property.BLOBKEY)
+    pbval.set_stringvalue(mongo_value['value'].encode('utf-8'))
+    return False
+
+  def __init_property_fillers(self):
+    # fillers set the value (and meaning) of a Property PB from a stored
+    # value, returning True for raw properties. plain values are looked up by
+    # their exact type, dicts by their 'class' field.
+    self.__fillers = {
+      types.StringType: self.__fill_string,
+      types.UnicodeType: self.__fill_unicode,
+      types.BooleanType: self.__fill_bool,
+      types.IntType: self.__fill_int,
+      types.LongType: self.__fill_int,
+      types.FloatType: self.__fill_float,
+      datetime.datetime: self.__fill_datetime,
+      Binary: self.__fill_blob,
+      types.NoneType: self.__fill_none,
+      }
+    self.__class_fillers = {
+      'text': self.__fill_text,
+      'key': self.__fill_key,
+      'rating': self.__fill_rating,
+      'category': self.__fill_category,
+      'email': self.__fill_email,
+      'geopt': self.__fill_geopt,
+      'im': self.__fill_im,
+      'bytes': self.__fill_bytes,
+      'blobkey': self.__fill_blobkey,
+      }
+
+  def __property_for_mongo_value(self, name, mongo_value, multiple):
+    """Builds a Property PB straight from a single stored Mongo value.
+
+    Returns a tuple (property, raw), where raw is True if the property belongs
+    in the raw_property_list (Text and Blob values).
+    """
+    prop = entity_pb.Property()
+    prop.set_name(name.encode('utf-8'))
+    prop.set_multiple(multiple)
+
+    value_type = type(mongo_value)
+    if value_type is types.DictType:
+      filler = self.__class_fillers.get(mongo_value['class'])
+    else:
+      filler = self.__fillers.get(value_type)
+    if filler is not None:
+      return (prop, filler(prop, prop.mutable_value(), mongo_value))
+
+    # users (and anything unexpected) go through the datastore_types value
+    value = self.__create_value_for_mongo_value(mongo_value)
+    prop.CopyFrom(datastore_types.ToPropertyPb(name, value))
+    prop.set_multiple(multiple)
+    return (prop, isinstance(value, datastore_types._RAW_PROPERTY_TYPES))
+
+  def __key_entity_for_mongo_document(self, document):
+    """Builds an EntityProto holding just the key (and entity group) for a
+    document, which only needs to have an _id.
+    """
+    pb = entity_pb.EntityProto()
+    self.__fill_path(pb.mutable_key().mutable_path().add_element,
+                     document.pop("_id"))
+    pb.mutable_key().set_app(self.__app_id)
+    pb.mutable_entity_group().add_element().CopyFrom(pb.key().path().element(0))
+    return pb
+
   def __entity_for_mongo_document(self, document):
-    key = self.__key_for_id(document.pop("_id"))
-    entity = datastore.Entity(kind=key.kind(), parent=key.parent(), name=key.name())
+    pb = self.__key_entity_for_mongo_document(document)
 
-    for k in document.keys():
-      v = self.__create_value_for_mongo_value(document[k])
-      entity[k] = v
+    for (name, mongo_value) in document.iteritems():
+      if type(mongo_value) is types.DictType and mongo_value['class'] == 'list':
+        (values, multiple) = (mongo_value['list'], True)
+      else:
+        (values, multiple) = ([mongo_value], False)
 
-    pb = entity._ToPb()
-    # no decent way to initialize an Entity w/ an existing key...
-    if not key.name():
-      pb.key().path().element_list()[-1].set_id(key.id())
+      for value in values:
+        (prop, raw) = self.__property_for_mongo_value(name, value, multiple)
+        if raw:
+          pb.raw_property_list().append(prop)
+        else:
+          pb.property_list().append(prop)
 
     return pb
 
+  def __add_tags(self, mongo_value, tags):
+    value_type = type(mongo_value)
+    if value_type is types.DictType:
+      tag = mongo_value['class']
+      if tag == 'list':
+        for v in mongo_value['list']:
+          self.__add_tags(v, tags)
+    else:
+      tag = _VALUE_TAGS.get(value_type, 'other')
+    tags.add(tag)
+
+  def __tags_for_documents(self, documents):
+    """Returns a dict mapping property names to the set of value tags found in
+    documents.
+    """
+    properties = {}
+    for document in documents:
+      for (name, mongo_value) in document.iteritems():
+        if name == "_id":
+          continue
+        if name not in properties:
+          properties[name] = set()
+        self.__add_tags(mongo_value, properties[name])
+    return properties
+
+  def __store_schema(self, kind, properties):
+    update = {}
+    for (name, tags) in properties.iteritems():
+      update["properties." + name] = {"$each": list(tags)}
+    if update:
+      update = {"$addToSet": update}
+    else:
+      update = {"$set": {"kind": kind}}
+    self.__db[_SCHEMA_COLLECTION].update({"_id": kind}, update, upsert=True)
+
+  def __load_schema(self, kind):
+    """Reads the schema for kind from the schema collection.
+
+    Collections written before the registry existed have no schema stored, so
+    one gets built by scanning the collection the first time around.
+    """
+    document = self.__db[_SCHEMA_COLLECTION].find_one({"_id": kind})
+    if document is not None:
+      schema = {}
+      for (name, tags) in document.get("properties", {}).iteritems():
+        schema[name] = set(tags)
+    elif self.__db[kind].find_one() is not None:
+      schema = self.__tags_for_documents(self.__db[kind].find())
+      self.__store_schema(kind, schema)
+    else:
+      return None
+
+    self.__schema_lock.acquire()
+    try:
+      if self.__schemas.get(kind) != schema:
+        self.__schema_versions[kind] = self.__schema_versions.get(kind, 0) + 1
+      self.__schemas[kind] = schema
+    finally:
+      self.__schema_lock.release()
+    return schema
+
+  def __schema_for_kind(self, kind, names=()):
+    """Returns the schema (a dict mapping property names to sets of value tags)
+    for kind, or None if nothing of that kind has been stored.
+
+    The schema is loaded on first use. It is reloaded when it doesn't know of
+    one of the given property names, since another process may have stored
+    new properties, but at most once every _SCHEMA_MISS_TTL seconds.
+    Otherwise every query on a property nothing has would read it again.
+    """
+    schema = self.__schemas.get(kind)
+    if schema is not None and self.__knows_names(schema, names):
+      return schema
+
+    missed = self.__schema_misses.get(kind)
+    if missed is not None and time.time() - missed < _SCHEMA_MISS_TTL:
+      return schema
+
+    schema = self.__load_schema(kind)
+    if schema is not None and self.__knows_names(schema, names):
+      self.__schema_misses.pop(kind, None)
+    else:
+      self.__schema_misses[kind] = time.time()
+    return schema
+
+  def __knows_names(self, schema, names):
+    for name in names:
+      if name not in schema:
+        return False
+    return True
+
+  def __update_schema(self, kind, documents):
+    """Records any new property types from documents about to be written.
+    """
+    schema = self.__schemas.get(kind)
+    if schema is None:
+      schema = self.__load_schema(kind)
+
+    new_properties = {}
+    for (name, tags) in self.__tags_for_documents(documents).iteritems():
+      new_tags = tags - (schema or {}).get(name, set())
+      if new_tags:
+        new_properties[name] = new_tags
+    if schema is not None and not new_properties:
+      return
+
+    self.__store_schema(kind, new_properties)
+    self.__schema_lock.acquire()
+    try:
+      schema = dict(schema or {})
+      for (name, tags) in new_properties.iteritems():
+        schema[name] = schema.get(name, set()) | tags
+      self.__schema_versions[kind] = self.__schema_versions.get(kind, 0) + 1
+      self.__schemas[kind] = schema
+    finally:
+      self.__schema_lock.release()
+
+  def __query_type(self, tags):
+    """Decides how queries treat a property, from the tags of its values.
+    """
+    for query_type in ('list', 'category', 'geopt'):
+      if query_type in tags:
+        return query_type
+    orderable = tags - set(['null'])
+    if orderable and orderable <= _UNORDERABLE_TAGS:
+      return 'unorderable'
+    return 'plain'
+
+  def __reserve_ids(self, kind, size):
+    """Atomically reserves a contiguous block of size ids for kind.
+
+    Returns the first id in the block.
+    """
+    command = SON([("findandmodify", _COUNTERS_COLLECTION),
+                   ("query", {"_id": kind}),
+                   ("update", {"$inc": {"last": size}}),
+                   ("upsert", True),
+                   ("new", True)])
+    last = self.__db.command(command)["value"]["last"]
+    return last - size + 1
+
+  def __allocate_ids(self, kind, size=1):
+    """Hands out size sequential ids for kind.
+
+    Ids come from a block reserved in the counters collection, so there is
+    only a round trip to the server when the current block runs out.
+
+    Returns the first id of the range.
+    """
+    self.__id_lock.acquire()
+    try:
+      (first, last) = self.__id_blocks.get(kind, (1, 0))
+      if first + size - 1 > last:
+        block = max(size, _ID_BLOCK_SIZE)
+        first = self.__reserve_ids(kind, block)
+        last = first + block - 1
+      self.__id_blocks[kind] = (first + size, last)
+      return first
+    finally:
+      self.__id_lock.release()
+
+  def __save_documents(self, collection, documents, fresh=()):
+    """Writes a list of documents into a single collection, in order.
+
+    fresh is a set of ids that were just allocated, so shouldn't be in the
+    collection yet. Each run of documents with fresh ids is written with one
+    acknowledged batch insert. The documents of each other run are upserted
+    with a save() each without waiting for the server, then the run is
+    checked with one getLastError, which reports the run's last save.
+
+    Returns a tuple (written, error) where written is the number of documents
+    (from the start of the list) that were written and error is the exception
+    that stopped the write, or None.
+    """
+    coll = self.__db[collection]
+    i = 0
+    while i < len(documents):
+      inserting = documents[i]["_id"] in fresh
+      end = i + 1
+      while (end < len(documents) and
+             (documents[end]["_id"] in fresh) == inserting):
+        end += 1
+      run = documents[i:end]
+      try:
+        if inserting:
+          coll.insert(run, safe=True)
+        else:
+          for document in run:
+            coll.save(document)
+          error = self.__db.error()
+          if error is not None:
+            raise pymongo.errors.OperationFailure(error["err"])
+      except pymongo.errors.PyMongoError, e:
+        return (i + self.__stored_prefix(coll, run), e)
+      i = end
+    return (len(documents), None)
+
+  def __stored_prefix(self, coll, documents):
+    """Returns how many documents from the start of the list are stored just
+    as they were sent, for working out how far a failed write got. A
+    document that failed because its id was taken finds the one already
+    stored, which doesn't match.
+    """
+    stored = {}
+    for document in coll.find({"_id": {"$in": [document["_id"]
+                                                for document in documents]}}):
+      stored[_utf8(document["_id"])] = dict(document)
+    count = 0
+    for document in documents:
+      # what the server hands back for the document, datetimes rounded and
+      # strings decoded
+      sent = dict(BSON.from_dict(document).to_dict())
+      if stored.get(document["_id"]) != sent:
+        break
+      count += 1
+    return count
+
+  def __init_counts(self, counts):
+    # kind -> list of tuples of property names to keep counts by
+    self.__counts = {}
+    # (when it was read, ids of the built sets of counts)
+    self.__built_counts = (None, frozenset())
+    built = self.__built_count_ids()
+    for (kind, names) in counts:
+      kind = unicode(kind)
+      names = tuple(sorted([unicode(name) for name in names]))
+      self.__counts.setdefault(kind, []).append(names)
+      if _counts_id(kind, names) not in built:
+        self.__build_counts(kind, names)
+
+  def __build_counts(self, kind, names):
+    """Counts the entities already stored for a newly configured set of
+    counts, or for one that went stale.
+    """
+    counts_id = _counts_id(kind, names)
+    # every id starting with counts_id, which ends in a "\0"
+    self.__db[_COUNTS_COLLECTION].remove({"_id": {"$gte": counts_id,
+                                                  "$lt": counts_id[:-1] + u"\1"}})
+    deltas = {}
+    for document in self.__db[kind].find({}, fields=list(names)):
+      for id in self.__count_ids_for_document(kind, names, document):
+        deltas[id] = deltas.get(id, 0) + 1
+    self.__apply_count_deltas(deltas)
+    self.__db[_METADATA_COLLECTION].update({"_id": "counts"},
+                                           {"$addToSet": {"built": counts_id}},
+                                           upsert=True)
+
+  def __built_count_ids(self):
+    (read, built) = self.__built_counts
+    now = time.time()
+    if read is None or now - read >= _BUILT_COUNTS_TTL:
+      metadata = self.__db[_METADATA_COLLECTION].find_one({"_id": "counts"})
+      built = frozenset(metadata and metadata.get("built") or [])
+      self.__built_counts = (now, built)
+    return built
+
+  def __mark_counts_stale(self, collection):
+    """Takes every set of counts for collection that this stub doesn't keep
+    off the built list, before writing to it. Stubs that do keep them stop
+    answering from them, and rebuild them when they next start.
+
+    Every stub does this whether it keeps counts or not, as it can't know
+    what other processes keep, but only for kinds with counts built. The
+    update isn't acknowledged, so it costs no round trip, but goes ahead of
+    the write on the same connection.
+    """
+    kind = collection.decode('utf-8')
+    prefix = kind + u"\0"
+    kept = [_counts_id(kind, names) for names in self.__counts.get(kind, [])]
+    built = self.__built_count_ids()
+    stale = [id for id in built if id.startswith(prefix) and id not in kept]
+    if not stale:
+      return
+    self.__db[_METADATA_COLLECTION].update({"_id": "counts"},
+                                           {"$pull": {"built": {"$in": stale}}})
+    self.__built_counts = (self.__built_counts[0], built - frozenset(stale))
+
+  def __counts_built(self, kind, names):
+    document = self.__db[_METADATA_COLLECTION].find_one(
+        {"_id": "counts", "built": _counts_id(kind, names)}, fields=["_id"])
+    return document is not None
+
+  def __count_ids_for_document(self, kind, names, document):
+    """Returns the ids of the counts that a document is counted in, one for
+    each combination of its values for names (a list counts under each of
+    its values).
+    """
+    choices = []
+    for name in names:
+      if name not in document:
+        return []
+      value = document[name]
+      if isinstance(value, dict) and value.get("class") == "list":
+        values = value["list"]
+      else:
+        values = [value]
+      choices.append(sorted(set([_count_value_key(v) for v in values])))
+
+    combinations = [[]]
+    for keys in choices:
+      combinations = [combination + [key]
+                      for combination in combinations for key in keys]
+    counts_id = _counts_id(kind, names)
+    return [counts_id + u"\0".join(combination)
+            for combination in combinations]
+
+  def __count_deltas(self, kind, document, sign, deltas):
+    if document is None:
+      return
+    for names in self.__counts[kind]:
+      for id in self.__count_ids_for_document(kind, names, document):
+        deltas[id] = deltas.get(id, 0) + sign
+
+  def __apply_count_deltas(self, deltas):
+    for (id, delta) in deltas.iteritems():
+      if delta:
+        self.__db[_COUNTS_COLLECTION].update({"_id": id},
+                                             {"$inc": {"count": delta}},
+                                             upsert=True)
+
+  def __documents_for_counts(self, collection, ids):
+    """Returns a dict of the stored documents with the given ids, holding
+    just the properties that counts are kept by.
+    """
+    names = set()
+    for property_names in self.__counts[collection]:
+      names.update(property_names)
+    documents = {}
+    for document in self.__db[collection].find({"_id": {"$in": ids}},
+                                               fields=list(names)):
+      documents[_utf8(document["_id"])] = document
+    return documents
+
+  def __materialized_count(self, query):
+    """Returns the number of entities matching query from the kept counts,
+    or None if there isn't a count for it.
+    """
+    kind = query.kind().decode('utf-8')
+    if kind not in self.__counts or query.has_ancestor():
+      return None
+
+    values = {}
+    for filt in query.filter_list():
+      if (filt.op() != datastore_pb.Query_Filter.EQUAL or
+          filt.property_size() != 1):
+        return None
+      prop = filt.property(0)
+      name = prop.name().decode('utf-8')
+      if name in values or name == "__key__":
+        return None
+      values[name] = self.__create_mongo_value_for_value(
+          datastore_types.FromPropertyPb(prop))
+
+    names = tuple(sorted(values.keys()))
+    if names not in self.__counts[kind] or not self.__counts_built(kind, names):
+      return None
+    id = _counts_id(kind, names) + u"\0".join([_count_value_key(values[name])
+                                               for name in names])
+    document = self.__db[_COUNTS_COLLECTION].find_one({"_id": id})
+    if document is None:
+      return 0
+    return document["count"]
+
   def _Dynamic_Put(self, put_request, put_response):
+    entities = []
+    collections = []
+    batches = {}
     for entity in put_request.entity_list():
       clone = entity_pb.EntityProto()
       clone.CopyFrom(entity)
@@ -260,9 +2131,10 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
       assert clone.key().path().element_size() > 0
 
       last_path = clone.key().path().element_list()[-1]
+      allocated = False
       if last_path.id() == 0 and not last_path.has_name():
-        # HACK just using a random id...
-        last_path.set_id(random.randint(-sys.maxint-1, sys.maxint))
+        last_path.set_id(self.__allocate_ids(last_path.type()))
+        allocated = True
 
         assert clone.entity_group().element_size() == 0
         group = clone.mutable_entity_group()
@@ -274,51 +2146,283 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
                 clone.entity_group().element_size() > 0)
 
       collection = self.__collection_for_key(clone.key())
+      if collection not in batches:
+        collections.append(collection)
+        batches[collection] = ([], [], set())
+      (indexes, documents, fresh) = batches[collection]
+      indexes.append(len(entities))
       document = self.__mongo_document_for_entity(clone)
+      documents.append(document)
+      if allocated:
+        fresh.add(document["_id"])
+      entities.append(clone)
+
+    written = []
+    for collection in collections:
+      (indexes, documents, fresh) = batches[collection]
+      self.__update_schema(collection, documents)
+
+      # the request's next Get of these reads what was stored
+      scope = self.__request_scope()
+      if scope is not None:
+        for document in documents:
+          scope.pop((collection, document["_id"]), None)
+
+      if collection.decode('utf-8') in self.__write_behind_kinds:
+        self.__hold_documents(collection, documents, fresh)
+        written.extend(indexes)
+        continue
 
-      id = self.__db[collection].save(document)
-      put_response.key_list().append(self.__key_for_id(id)._ToPb())
+      while True:
+        (count, error) = self.__write_documents(collection, documents, fresh)
+        written.extend(indexes[:count])
+        if (error is None or documents[count]["_id"] not in fresh or
+            not _is_duplicate_key_error(error)):
+          break
+        # the allocated id was already taken by an entity stored with an
+        # explicit id, so give this one another and carry on from it
+        entity = entities[indexes[count]]
+        self.__reallocate_id(entity)
+        document = self.__mongo_document_for_entity(entity)
+        fresh.add(document["_id"])
+        if scope is not None:
+          scope.pop((collection, document["_id"]), None)
+        indexes = indexes[count:]
+        documents = [document] + documents[count + 1:]
+
+      if error is not None:
+        written.sort()
+        raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.INTERNAL_ERROR,
+          "Put failed writing to %r after writing entities %r of the request: "
+          "%s" % (collection, written, error))
+
+    for entity in entities:
+      put_response.key_list().append(entity.key())
+
+  def __reallocate_id(self, entity):
+    last_path = entity.key().path().element_list()[-1]
+    last_path.set_id(self.__allocate_ids(last_path.type()))
+    # a root entity is its own entity group
+    entity.mutable_entity_group().mutable_element(0).CopyFrom(
+        entity.key().path().element(0))
+
+  def __write_documents(self, collection, documents, fresh=()):
+    """Saves documents to collection, keeping the counts and caches up to
+    date. Returns a tuple (written, error) like __save_documents.
+    """
+    self.__mark_counts_stale(collection)
+
+    # pair each document with the one it replaces, for updating counts
+    if collection in self.__counts:
+      current = self.__documents_for_counts(
+          collection, [document["_id"] for document in documents
+                       if document["_id"] not in fresh])
+      replaced = []
+      for document in documents:
+        replaced.append(current.get(document["_id"]))
+        current[document["_id"]] = document
+
+    (count, error) = self.__save_documents(collection, documents, fresh)
+    self.__invalidate_caches(
+        [(collection, [document["_id"] for document in documents])])
+
+    if collection in self.__counts:
+      deltas = {}
+      for (old, new) in zip(replaced[:count], documents[:count]):
+        self.__count_deltas(collection, old, -1, deltas)
+        self.__count_deltas(collection, new, 1, deltas)
+      self.__apply_count_deltas(deltas)
+    return (count, error)
+
+  def __group_ids_by_collection(self, keys):
+    """Groups the db ids for a list of key PBs by collection.
+
+    Returns a tuple (ids, groups): ids is a list of (collection, id) pairs in
+    the same order as keys, groups is a list of (collection, [unique ids])
+    pairs ordered by first appearance.
+    """
+    ids = []
+    collections = []
+    groups = {}
+    for key in keys:
+      collection = self.__collection_for_key(key)
+      id = self.__id_for_key(key)
+      ids.append((collection, id))
+      if collection not in groups:
+        collections.append(collection)
+        groups[collection] = ([], set())
+      (unique, seen) = groups[collection]
+      if id not in seen:
+        seen.add(id)
+        unique.append(id)
+    return (ids, [(c, groups[c][0]) for c in collections])
+
+  def __is_cached(self, collection):
+    return (self.__entity_cache is not None and
+            collection.decode('utf-8') not in self.__uncached_kinds)
+
+  def __invalidate_caches(self, groups):
+    """Drops written entities from the entity cache, moves the written kinds
+    on to new versions, and tells other processes to do the same. Called
+    after the write, so a Get or query that read the old data can't cache it
+    again afterwards.
+    """
+    if self.__invalidation_bus is not None:
+      keys = []
+      for (collection, unique_ids) in groups:
+        keys.extend([(collection, id) for id in unique_ids])
+      self.__invalidation_bus.publish(self.__bus_id, keys)
 
-  def _Dynamic_Get(self, get_request, get_response):
-    for key in get_request.key_list():
-        collection = self.__collection_for_key(key)
-        id = self.__id_for_key(key)
-
-        group = get_response.add_entity()
-        document = self.__db[collection].find_one({"_id": id})
-        if document is None:
-          entity = None
-        else:
-          entity = self.__entity_for_mongo_document(document)
+    for (collection, unique_ids) in groups:
+      self.__kind_versions[collection] = self.__write_counter.next()
+
+    if self.__entity_cache is None:
+      return
+    self.__entity_cache_lock.acquire()
+    try:
+      self.__entity_cache_generation += 1
+      for (collection, unique_ids) in groups:
+        for id in unique_ids:
+          self.__entity_cache.pop((collection, id))
+    finally:
+      self.__entity_cache_lock.release()
+
+  def __receive_invalidations(self, sender, keys):
+    if sender == self.__bus_id:
+      return
+    if keys is None:
+      self.__versions_epoch = self.__write_counter.next()
+    else:
+      for (collection, id) in keys:
+        self.__kind_versions[_utf8(collection)] = self.__write_counter.next()
+
+    if self.__entity_cache is None:
+      return
+    self.__entity_cache_lock.acquire()
+    try:
+      self.__entity_cache_generation += 1
+      if keys is None:
+        self.__entity_cache.clear()
+        return
+      for (collection, id) in keys:
+        self.__entity_cache.pop((_utf8(collection), _utf8(id)))
+    finally:
+      self.__entity_cache_lock.release()
+
+  def __request_scope(self):
+    return getattr(self.__request_scopes, "entities", None)
 
-        if entity:
+  def _Dynamic_Get(self, get_request, get_response):
+    (ids, groups) = self.__group_ids_by_collection(get_request.key_list())
+    self.Flush([collection for (collection, _) in groups])
+    generation = self.__entity_cache_generation
+
+    # keys already read in this request don't need reading again
+    scope = self.__request_scope()
+    if scope is not None:
+      groups = [(collection, [id for id in unique_ids
+                              if (collection, id) not in scope])
+                for (collection, unique_ids) in groups]
+
+    # encoded entities, from the cache or freshly read
+    encoded = {}
+    documents = {}
+    for (collection, unique_ids) in groups:
+      if not unique_ids:
+        continue
+      cached = self.__is_cached(collection)
+      if cached:
+        missing = []
+        for id in unique_ids:
+          entity = self.__entity_cache.get((collection, id))
+          if entity is None:
+            missing.append(id)
+          else:
+            encoded[(collection, id)] = entity
+        unique_ids = missing
+        if not unique_ids:
+          continue
+
+      if len(unique_ids) == 1:
+        spec = {"_id": unique_ids[0]}
+      else:
+        spec = {"_id": {"$in": unique_ids}}
+      for document in self.__db[collection].find(spec):
+        collection_and_id = (collection, _utf8(document["_id"]))
+        documents[collection_and_id] = document
+        if cached:
+          entity = self.__entity_for_mongo_document(dict(document)).Encode()
+          encoded[collection_and_id] = entity
+          self.__entity_cache_lock.acquire()
+          try:
+            if generation == self.__entity_cache_generation:
+              self.__entity_cache.put(collection_and_id, entity)
+          finally:
+            self.__entity_cache_lock.release()
+
+    for collection_and_id in ids:
+      group = get_response.add_entity()
+      if scope is not None and collection_and_id in scope:
+        entity = scope[collection_and_id]
+        if entity is not None:
           group.mutable_entity().CopyFrom(entity)
+        continue
+
+      if collection_and_id in encoded:
+        group.mutable_entity().ParseFromString(encoded[collection_and_id])
+      elif collection_and_id in documents:
+        # decoding consumes the document, so hand it a copy in case the same
+        # key was requested more than once
+        entity = self.__entity_for_mongo_document(
+            dict(documents[collection_and_id]))
+        group.mutable_entity().CopyFrom(entity)
+
+      if scope is not None:
+        entity = None
+        if group.has_entity():
+          entity = entity_pb.EntityProto()
+          entity.CopyFrom(group.entity())
+        scope[collection_and_id] = entity
 
   def _Dynamic_Delete(self, delete_request, delete_response):
-    for key in delete_request.key_list():
-      collection = self.__collection_for_key(key)
-      id = self.__id_for_key(key)
-      self.__db[collection].remove({"_id": id})
+    (ids, groups) = self.__group_ids_by_collection(delete_request.key_list())
+    # a held Put of one of these would bring it back when it was written
+    self.Flush([collection for (collection, _) in groups])
+    for (collection, unique_ids) in groups:
+      self.__mark_counts_stale(collection)
+      if collection in self.__counts:
+        deltas = {}
+        for document in self.__documents_for_counts(collection,
+                                                    unique_ids).itervalues():
+          self.__count_deltas(collection, document, -1, deltas)
+
+      if len(unique_ids) == 1:
+        self.__db[collection].remove({"_id": unique_ids[0]})
+      else:
+        self.__db[collection].remove({"_id": {"$in": unique_ids}})
+
+      if collection in self.__counts:
+        self.__apply_count_deltas(deltas)
+    self.__invalidate_caches(groups)
+
+    scope = self.__request_scope()
+    if scope is not None:
+      for collection_and_id in ids:
+        scope[collection_and_id] = None
 
-  def __special_props(self, value, direction):
-    if isinstance(value, datastore_types.Category):
+  def __special_props(self, query_type, direction):
+    if query_type == 'category':
       return ["category"]
-    if isinstance(value, datastore_types.GeoPt):
+    if query_type == 'geopt':
       return ["lat", "lon"]
-    if isinstance(value, list):
+    if query_type == 'list':
       if direction == pymongo.ASCENDING:
         return ["ascending_sort_key"]
       return ["descending_sort_key"]
     return None
 
-  def __unorderable(self, value):
-    if isinstance(value, datastore_types.Text):
-      return True
-    if isinstance(value, datastore_types.Blob):
-      return True
-    return False
-
-  def __translate_order_for_mongo(self, order_list, prototype):
+  def __translate_order_for_mongo(self, order_list, schema):
     mongo_ordering = []
 
     for o in order_list:
@@ -332,10 +2436,13 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
         mongo_ordering.append((key, value))
         continue
 
-      if key not in prototype or self.__unorderable(prototype[key]):
+      if key not in schema:
+        return None
+      query_type = self.__query_type(schema[key])
+      if query_type == 'unorderable':
         return None
 
-      props = self.__special_props(prototype[key], value)
+      props = self.__special_props(query_type, value)
       if props:
         for prop in props:
           mongo_ordering.append((key + "." + prop, value))
@@ -343,42 +2450,375 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
         mongo_ordering.append((key, value))
     return mongo_ordering
 
-  def __filter_suffix(self, value):
-    if isinstance(value, types.ListType):
-      return ".list"
-    return ""
+  def __ancestor_bounds(self, ancestor):
+    """Returns a condition on _id matching ancestor and its descendants, as a
+    range that can be scanned straight off of the _id index.
+    """
+    return self.__key_format.ancestor_bounds(self.__id_for_key(ancestor))
+
+  def __merge_condition(self, spec, key, condition):
+    """Merges condition (a value to match or a dict of operators) into the
+    condition on key in spec.
+
+    Bounds on the same side keep the tighter one, and $in lists are
+    intersected.
+
+    Returns False if the merged condition can't match anything.
+    """
+    if key not in spec:
+      spec[key] = condition
+      return True
+
+    existing = spec[key]
+    if not isinstance(existing, types.DictType):
+      if not isinstance(condition, types.DictType):
+        return existing == condition
+      (existing, condition) = (condition, existing)
+    if not isinstance(condition, types.DictType):
+      condition = {"$in": [condition]}
+
+    merged = dict(existing)
+    for (operator, value) in condition.items():
+      if operator not in merged:
+        merged[operator] = value
+      elif operator in ("$gt", "$gte"):
+        merged[operator] = max(merged[operator], value)
+      elif operator in ("$lt", "$lte"):
+        merged[operator] = min(merged[operator], value)
+      elif operator == "$in":
+        merged[operator] = [v for v in merged[operator] if v in value]
+        if not merged[operator]:
+          return False
+      else:
+        merged[operator] = value
+    spec[key] = merged
+    return True
+
+  def __query_shape(self, query):
+    return (query.kind(),
+            query.has_ancestor(),
+            tuple([(filt.property(0).name(), filt.op())
+                   for filt in query.filter_list()]),
+            tuple([(o.property(), o.direction()) for o in query.order_list()]))
+
+  def __compile_query(self, query):
+    kind = query.kind()
+    names = [filt.property(0).name().decode('utf-8')
+             for filt in query.filter_list()]
+    names.extend([o.property().decode('utf-8') for o in query.order_list()
+                  if o.property() != "__key__"])
+
+    schema = self.__schema_for_kind(kind, names)
+    version = self.__schema_versions.get(kind, 0)
+    if schema is None:
+      return _QueryPlan(version, False, [], None)
+
+    complete = True
+    for name in names:
+      if name not in schema:
+        complete = False
+
+    bindings = []
+    for filt in query.filter_list():
+      if filt.op() not in _FILTER_OPERATORS:
+        raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.BAD_REQUEST,
+          "Can't handle operation %r." % filt.op())
+
+      key = filt.property(0).name().decode('utf-8')
+      if key == "__key__":
+        bindings.append(("_id", True, _FILTER_OPERATORS[filt.op()]))
+        continue
+      if key in schema and self.__query_type(schema[key]) == 'list':
+        key += ".list"
+      bindings.append((key, False, _FILTER_OPERATORS[filt.op()]))
+
+    order = self.__translate_order_for_mongo(query.order_list(), schema)
+    return _QueryPlan(version, complete, bindings, order)
+
+  def __plan_for_query(self, query):
+    """Returns the compiled plan for query's shape.
+
+    Plans are cached, and recompiled when the kind's schema has changed since
+    they were compiled or when they use properties the schema didn't know.
+    """
+    shape = self.__query_shape(query)
+    plan = self.__query_plans.get(shape)
+    if (plan is None or not plan.complete or
+        plan.schema_version != self.__schema_versions.get(query.kind(), 0)):
+      plan = self.__compile_query(query)
+      self.__query_plans.put(shape, plan)
+    return plan
+
+  def __translate_query(self, query):
+    """Translates query into a Mongo spec and sort order.
+
+    Returns a tuple (spec, order), or None if the query can't match anything.
+    """
+    plan = self.__plan_for_query(query)
+    if plan.order is None:
+      return None
+
+    spec = {}
+
+    for (filt, (key, is_key, operator)) in zip(query.filter_list(),
+                                               plan.bindings):
+      if is_key:
+        values = [self.__id_for_path(prop.value().referencevalue().pathelement_list())
+                  for prop in filt.property_list()]
+      else:
+        values = [self.__create_mongo_value_for_value(datastore_types.FromPropertyPb(prop))
+                  for prop in filt.property_list()]
+
+      if operator is None:
+        condition = values[0]
+      elif operator == "$in":
+        condition = {operator: values}
+      else:
+        condition = {operator: values[0]}
+
+      if not self.__merge_condition(spec, key, condition):
+        return None
+
+    if query.has_ancestor():
+      if not self.__merge_condition(spec, "_id",
+                                    self.__ancestor_bounds(query.ancestor())):
+        return None
 
-  def __filter_binding(self, key, value, operation, prototype):
-    if key in prototype:
-      key += self.__filter_suffix(prototype[key])
+    return (spec, plan.order)
 
-    if key == "__key__":
-      key = "_id"
-      value = self.__id_for_key(value._ToPb())
+  def __order_with_key(self, order):
+    """Adds _id to the end of a Mongo sort order, so that every result has a
+    distinct place in it.
+    """
+    for (field, _) in order:
+      if field == "_id":
+        return order
+    return order + [("_id", pymongo.ASCENDING)]
+
+  def __position_function(self, order):
+    """Returns a function giving a document's place in order, as a list of
+    its values for each of the sort fields. Missing fields are None.
+    """
+    paths = [field.split(".") for (field, _) in order]
+    def position(document):
+      values = []
+      for path in paths:
+        value = document
+        for name in path:
+          if not isinstance(value, dict):
+            value = None
+            break
+          value = value.get(name)
+        # embedded documents compare field by field in order, so keep it
+        if isinstance(value, dict):
+          value = SON(value)
+        values.append(value)
+      return values
+    return position
+
+  def __conditions_after_position(self, order, position):
+    """Returns a list of conditions, one of which is met by each document
+    that comes after position in order. This is a range on the sort fields
+    rather than a skip, so the server can seek straight to the position in
+    an index.
+
+    Missing and null values sort before everything else, so after a null
+    come all the non-null values (ascending) or nothing (descending), and
+    after any other value in descending order come the nulls.
+    """
+    conditions = []
+    for i in range(len(order)):
+      condition = {}
+      for j in range(i):
+        condition[order[j][0]] = position[j]
+      (field, direction) = order[i]
+      value = position[i]
+      if direction == pymongo.ASCENDING:
+        if value is None:
+          condition[field] = {"$ne": None}
+        else:
+          condition[field] = {"$gt": value}
+        conditions.append(condition)
+      elif value is not None:
+        condition[field] = {"$lt": value}
+        conditions.append(condition)
+        condition = dict(condition)
+        condition[field] = None
+        conditions.append(condition)
+    return conditions
+
+  def __projection_decoder(self, projection):
+    # the sort fields are fetched too to make query cursors from, so drop
+    # the ones that weren't asked for before making entities
+    wanted = set(projection)
+    wanted.add("_id")
+    def decode(document):
+      for name in document.keys():
+        if name not in wanted:
+          del document[name]
+      return self.__entity_for_mongo_document(document)
+    return decode
+
+  # query cursors are opaque to the client. ours hold a BSON document with the
+  # query's sort order and the place in it to start after, which the client
+  # hands back in a CompiledCursor. older SDKs have a list of positions in a
+  # CompiledCursor, later ones have just the one.
+  def __start_for_compiled_cursor(self, compiled_cursor):
+    if hasattr(compiled_cursor, "position_list"):
+      positions = compiled_cursor.position_list()
+    elif compiled_cursor.has_position():
+      positions = [compiled_cursor.position()]
     else:
-      value = self.__create_mongo_value_for_value(value)
-
-    if operation == "<":
-      return (key, {'$lt': value})
-    elif operation == '<=':
-      return (key, {'$lte': value})
-    elif operation == '>':
-      return (key, {'$gt': value})
-    elif operation == '>=':
-      return (key, {'$gte': value})
-    elif operation == '==':
-      return (key, value)
-    raise apiproxy_errors.ApplicationError(
-      datastore_pb.Error.BAD_REQUEST, "Can't handle operation %r." % operation)
+      positions = []
+    if not positions or not positions[0].has_start_key():
+      return None
+    return positions[0].start_key()
+
+  def __position_for_cursor(self, start, order):
+    try:
+      # embedded documents in the position have to keep their field order.
+      # drivers that can decode into other classes default to dict, older
+      # ones always give SON
+      try:
+        cursor = BSON(start).to_dict(SON)
+      except TypeError:
+        cursor = BSON(start).to_dict()
+      cursor_order = [(field, direction)
+                      for (field, direction) in cursor["order"]]
+      position = cursor["position"]
+    except Exception:
+      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+                                             'Invalid query cursor')
+    if cursor_order != order or len(position) != len(order):
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.BAD_REQUEST,
+          'Query cursor was not made by a query with the same sort order')
+    return position
+
+  def __set_compiled_cursor(self, open_query, query_result):
+    if open_query.position is None or open_query.last_position is None:
+      return
+    start = BSON.from_dict(SON([
+        ("order", [[field, direction]
+                   for (field, direction) in open_query.order]),
+        ("position", open_query.last_position),
+        ]))
+    compiled_cursor = query_result.mutable_compiled_cursor()
+    if hasattr(compiled_cursor, "add_position"):
+      compiled_cursor.add_position().set_start_key(str(start))
+    else:
+      compiled_cursor.mutable_position().set_start_key(str(start))
 
   def _Dynamic_RunQuery(self, query, query_result):
+    # most queries are read to the end by RunQuery and never touch the cursor
+    # registry, so reap idle cursors here rather than waiting for one that does
+    self.__queries.expire()
+    self.Flush([query.kind()])
+    if self.__is_query_cacheable(query):
+      open_query = self.__run_cached_query(query, query_result)
+    else:
+      open_query = self.__run_query(query, query_result)
+    # queries that were read to the end by RunQuery don't need a cursor
+    if open_query is not None and open_query.more_results():
+      cursor_index = self.__register_cursor(open_query)
+      query_result.mutable_cursor().set_cursor(cursor_index)
+      query_result.set_more_results(True)
+
+  def __is_query_cacheable(self, query):
+    # only queries with a bounded number of results, that don't start from
+    # or give out query cursors
+    return (self.__query_cache is not None and
+            query.has_limit() and 0 < query.limit() <= _MAXIMUM_RESULTS and
+            not (hasattr(query, "compile") and query.compile()) and
+            not (hasattr(query, "has_compiled_cursor") and
+                 query.has_compiled_cursor()) and
+            query.kind().decode('utf-8') not in self.__uncached_kinds)
+
+  def __cached_results_size(self, value):
+    size = 1
+    for encoded in value[1]:
+      size += len(encoded)
+    return size
+
+  def __count_query_cache_lookup(self, query, hit):
+    shape = self.__query_shape(query)
+    self.__query_cache_lock.acquire()
+    try:
+      counts = self.__query_cache_shapes.setdefault(shape, [0, 0])
+      if hit:
+        counts[0] += 1
+      else:
+        counts[1] += 1
+    finally:
+      self.__query_cache_lock.release()
+
+  def __run_cached_query(self, query, query_result):
+    """Runs a query with results from the query cache, or runs it for real
+    and caches all of its results.
+    """
+    key = query.Encode()
+    collection = query.kind()
+    version = (self.__versions_epoch, self.__kind_versions.get(collection))
+
+    cached = self.__query_cache.get(key)
+    if cached is not None and cached[0] != version:
+      self.__query_cache.pop(key)
+      cached = None
+    self.__count_query_cache_lookup(query, cached is not None)
+
+    if cached is None:
+      open_query = self.__run_query(query, query_result, True)
+      if open_query is not None:
+        results = [entity.Encode() for entity in query_result.result_list()]
+        results.extend([entity.Encode() for entity in open_query.buffered])
+        self.__query_cache.put(key, (version, results))
+      return open_query
+
+    self.__begin_query(query, query_result)
+
+    open_query = _OpenQuery(None, None)
+    open_query.exhausted = True
+    for encoded in cached[1]:
+      entity = entity_pb.EntityProto()
+      entity.ParseFromString(encoded)
+      open_query.buffered.append(entity)
+    self.__start_results(query, open_query, query_result)
+    return open_query
+
+  def __register_cursor(self, open_query):
+    self.__cursor_lock.acquire()
+    try:
+      cursor_index = self.__next_cursor
+      self.__next_cursor += 1
+    finally:
+      self.__cursor_lock.release()
+    self.__queries.put(cursor_index, open_query)
+    return cursor_index
+
+  def __close_cursor(self, cursor_index, open_query):
+    open_query.close()
+
+  def __batch_size_for_query(self, query):
+    # newer SDKs say how many results they want back from RunQuery. older
+    # ones always follow up with a Next for a page of the query's limit, or
+    # the iterator's buffer size if there isn't one.
+    if hasattr(query, "has_count") and query.has_count():
+      count = query.count()
+    elif query.has_limit():
+      count = query.limit()
+    else:
+      count = _DEFAULT_BATCH_SIZE
+    # the server treats a batch size of one as "return one and close"
+    return max(2, min(count, _MAXIMUM_RESULTS))
+
+  def __check_query(self, query):
+    """Checks that a query is allowed, and records it in the query history.
+    """
     if query.has_offset() and query.offset() > _MAX_QUERY_OFFSET:
       raise apiproxy_errors.ApplicationError(
           datastore_pb.Error.BAD_REQUEST, 'Too big query offset.')
 
-    if query.keys_only():
-      query_result.set_keys_only(True)
-
     num_components = len(query.filter_list()) + len(query.order_list())
     if query.has_ancestor():
       num_components += 1
@@ -388,11 +2828,6 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
           ('query is too large. may not have more than %s filters'
            ' + sort orders ancestor total' % _MAX_QUERY_COMPONENTS))
 
-    app = query.app()
-
-    query_result.mutable_cursor().set_cursor(0)
-    query_result.set_more_results(False)
-
     if self.__require_indexes:
       required, kind, ancestor, props, num_eq_filters = datastore_index.CompositeIndexForQuery(query)
       if required:
@@ -410,8 +2845,6 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
               "This query requires a composite index that is not defined. "
               "You must update the index.yaml file in your application root.")
 
-    collection = query.kind()
-
     clone = datastore_pb.Query()
     clone.CopyFrom(query)
     clone.clear_hint()
@@ -420,56 +2853,66 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
     else:
       self.__query_history[clone] = 1
 
-    # HACK we need to get one Entity from this collection so we know what the
-    # property types are (because we need to construct queries that depend on
-    # the types of the properties)...
-    prototype = self.__db[collection].find_one()
-    if prototype is None:
-      return
-    prototype = datastore.Entity._FromPb(self.__entity_for_mongo_document(prototype))
-
-    spec = {}
-
-    if query.has_ancestor():
-      spec["_id"] = re.compile("^%s.*$" % self.__id_for_key(query.ancestor()))
-
-    operators = {datastore_pb.Query_Filter.LESS_THAN:             '<',
-                 datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL:    '<=',
-                 datastore_pb.Query_Filter.GREATER_THAN:          '>',
-                 datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: '>=',
-                 datastore_pb.Query_Filter.EQUAL:                 '==',
-                 }
-
-    for filt in query.filter_list():
-      assert filt.op() != datastore_pb.Query_Filter.IN
-
-      prop = filt.property(0).name().decode('utf-8')
-      op = operators[filt.op()]
-
-      filter_val_list = [datastore_types.FromPropertyPb(filter_prop)
-                         for filter_prop in filt.property_list()]
+  def __begin_query(self, query, query_result):
+    self.__check_query(query)
+    if query.keys_only():
+      query_result.set_keys_only(True)
+    query_result.mutable_cursor().set_cursor(0)
+    query_result.set_more_results(False)
 
-      (key, value) = self.__filter_binding(prop, filter_val_list[0], op, prototype)
+  def __run_query(self, query, query_result, read_all=False):
+    """Runs a query, returning an _OpenQuery for its results, or None if it
+    can't match anything.
 
-      if key in spec:
-        if not isinstance(spec[key], types.DictType) and not isinstance(value, types.DictType):
-          if spec[key] != value:
-            return
-        elif not isinstance(spec[key], types.DictType):
-          value["$in"] = [spec[key]]
-          spec[key] = value
-        elif not isinstance(value, types.DictType):
-          spec[key]["$in"] = [value]
-        else:
-          spec[key].update(value)
-      else:
-        spec[key] = value
+    The first batch of results is fetched straight away: into query_result
+    itself if the client asked for results from RunQuery, otherwise into a
+    buffer that the first Next call takes from. If read_all is true, every
+    result is fetched (the query must have a limit).
+    """
+    self.__begin_query(query, query_result)
 
-    cursor = self.__db[collection].find(spec)
+    collection = query.kind()
+    translation = self.__translate_query(query)
+    if translation is None:
+      return None
+    (spec, order) = translation
+
+    # newer SDKs can ask for just some of the properties (a projection query)
+    if hasattr(query, "property_name_list"):
+      projection = [name.decode('utf-8') for name in query.property_name_list()]
+    else:
+      projection = []
+
+    # and for query cursors, which name a place in the results to start from
+    compile = hasattr(query, "compile") and query.compile()
+    start = None
+    if hasattr(query, "has_compiled_cursor") and query.has_compiled_cursor():
+      start = self.__start_for_compiled_cursor(query.compiled_cursor())
+    position = None
+    sort_fields = []
+    if compile or start is not None:
+      order = self.__order_with_key(order)
+      if start is not None:
+        start = self.__position_for_cursor(start, order)
+        spec["$or"] = self.__conditions_after_position(order, start)
+      if compile:
+        position = self.__position_function(order)
+        sort_fields = [field for (field, _) in order if field != "_id"]
 
-    order = self.__translate_order_for_mongo(query.order_list(), prototype)
-    if order is None:
-      return
+    if query.keys_only():
+      # only the keys are needed, so don't have the server send anything else
+      cursor = self.__db[collection].find(spec, fields=["_id"] + sort_fields)
+      decode = self.__key_entity_for_mongo_document
+    elif projection:
+      # results are partial entities with just the requested properties
+      cursor = self.__db[collection].find(spec, fields=(["_id"] + projection +
+                                                        sort_fields))
+      decode = self.__entity_for_mongo_document
+      if sort_fields:
+        decode = self.__projection_decoder(projection)
+    else:
+      cursor = self.__db[collection].find(spec)
+      decode = self.__entity_for_mongo_document
     if order:
       cursor = cursor.sort(order)
 
@@ -478,14 +2921,27 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
     if query.has_limit():
       cursor = cursor.limit(query.limit())
 
-    self.__cursor_lock.acquire()
-    cursor_index = self.__next_cursor
-    self.__next_cursor += 1
-    self.__cursor_lock.release()
-    self.__queries[cursor_index] = cursor
-
-    query_result.mutable_cursor().set_cursor(cursor_index)
-    query_result.set_more_results(True)
+    open_query = _OpenQuery(cursor, decode, order, position, start)
+    # have the server send a whole page per round trip, rather than whatever
+    # its default first batch happens to be
+    batch_size = self.__batch_size_for_query(query)
+    if read_all:
+      batch_size = query.limit()
+    if hasattr(cursor, "batch_size"):
+      cursor.batch_size(batch_size)
+    if read_all:
+      open_query.read(batch_size)
+      open_query.exhausted = True
+    self.__start_results(query, open_query, query_result)
+    return open_query
+
+  def __start_results(self, query, open_query, query_result):
+    batch_size = self.__batch_size_for_query(query)
+    if hasattr(query, "has_count") and query.has_count():
+      query_result.result_list().extend(open_query.fetch(batch_size))
+      self.__set_compiled_cursor(open_query, query_result)
+    else:
+      open_query.read(batch_size)
 
   def _Dynamic_Next(self, next_request, query_result):
     cursor = next_request.cursor().cursor()
@@ -494,35 +2950,90 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
     if cursor == 0: # we exited early from the query w/ no results...
       return
 
-    try:
-      cursor = self.__queries[cursor]
-    except KeyError:
+    open_query = self.__queries.get(cursor)
+    if open_query is None:
       raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
                                              'Cursor %d not found' % cursor)
 
     count = next_request.count()
     if count == 0:
       count = 1
-    for _ in range(count):
-      try:
-        query_result.result_list().append(self.__entity_for_mongo_document(cursor.next()))
-      except StopIteration:
-        return
+    query_result.result_list().extend(open_query.fetch(count))
+    self.__set_compiled_cursor(open_query, query_result)
+
+    if not open_query.more_results():
+      # done with, so free the cursor now instead of waiting for it to expire
+      if self.__queries.pop(cursor) is not None:
+        open_query.close()
+      return
     query_result.set_more_results(True)
 
+    if self.__read_ahead_queue is not None:
+      self.__schedule_read_ahead(open_query, count)
+
+  def __schedule_read_ahead(self, open_query, count):
+    open_query.lock.acquire()
+    try:
+      if open_query.read_ahead_pending:
+        return
+      open_query.read_ahead_pending = True
+    finally:
+      open_query.lock.release()
+    self.__read_ahead_queue.put((open_query, count))
+
+  def __read_ahead_worker(self):
+    while True:
+      request = self.__read_ahead_queue.get()
+      # Close() asks the worker to stop with None
+      if request is None:
+        return
+      (open_query, count) = request
+      # stay under the total limit, counting what's buffered for every open
+      # cursor. this is only a snapshot, but it's only the worker that adds
+      # to the buffers after RunQuery.
+      buffered = 0
+      for other in self.__queries.values():
+        buffered += len(other.buffered)
+      limit = min(self.__read_ahead_results,
+                  len(open_query.buffered) + self.__read_ahead_total - buffered)
+      try:
+        open_query.read_ahead(count, limit)
+      except Exception:
+        logging.exception('reading query results ahead failed')
+
   def _Dynamic_Count(self, query, integer64proto):
-    query_result = datastore_pb.QueryResult()
-    self._Dynamic_RunQuery(query, query_result)
-    cursor_number = query_result.cursor().cursor()
-    if cursor_number == 0: # we exited early from the query w/ no results...
+    self.Flush([query.kind()])
+    self.__check_query(query)
+    offset = query.offset()
+    limit = None
+    if query.has_limit():
+      limit = query.limit()
+
+    count = self.__materialized_count(query)
+    if count is not None:
+      integer64proto.set_value(_clamp_count(count, offset, limit))
+      return
+
+    translation = self.__translate_query(query)
+    if translation is None or limit == 0:
       integer64proto.set_value(0)
+      return
+    (spec, _) = translation
+
+    collection = query.kind()
+    if not spec:
+      # the server keeps the number of documents in each collection
+      count = _clamp_count(self.__db[collection].count(), offset, limit)
     else:
-      cursor = self.__queries[cursor_number]
-      count = cursor.count()
-      del self.__queries[cursor_number]
-      if query.has_limit() and count > query.limit():
-        count = query.limit()
-      integer64proto.set_value(count)
+      # have the server stop counting once it gets past the limit
+      command = SON([("count", collection), ("query", spec)])
+      if offset:
+        command["skip"] = offset
+      if limit is not None:
+        command["limit"] = limit
+      response = self.__db.command(command, allowable_errors=["ns missing"])
+      count = int(response.get("n", 0))
+    integer64proto.set_value(count)
 
   def _Dynamic_BeginTransaction(self, request, transaction):
     transaction.set_handle(0)
@@ -534,12 +3045,59 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
   def _Dynamic_Rollback(self, transaction, transaction_response):
     logging.log(logging.WARN, 'transactions unsupported')
 
+  def __fill_schema_value(self, tag, value_pb):
+    if tag in ('string', 'text', 'category', 'email', 'im', 'bytes',
+               'blobkey', 'blob'):
+      value_pb.set_stringvalue('none')
+    elif tag in ('int', 'rating', 'datetime'):
+      value_pb.set_int64value(0)
+    elif tag == 'bool':
+      value_pb.set_booleanvalue(False)
+    elif tag == 'float':
+      value_pb.set_doublevalue(0.0)
+    elif tag == 'geopt':
+      value_pb.mutable_pointvalue().set_x(0.0)
+      value_pb.mutable_pointvalue().set_y(0.0)
+    elif tag == 'user':
+      value_pb.mutable_uservalue().set_email('none')
+      value_pb.mutable_uservalue().set_auth_domain('none')
+      value_pb.mutable_uservalue().set_gaiaid(0)
+    elif tag == 'key':
+      value_pb.mutable_referencevalue().set_app('none')
+      value_pb.mutable_referencevalue().add_pathelement().set_type('none')
+
   def _Dynamic_GetSchema(self, app_str, schema):
-    # TODO this is used for the admin viewer to introspect.
-    pass
+    # this is used for the admin viewer to introspect. each kind gets an
+    # EntityProto with one property per name, holding a placeholder value of
+    # each type that has been stored for it.
+    for collection in sorted(self.__db.collection_names()):
+      if _is_internal_collection(collection):
+        continue
+
+      kind_pb = entity_pb.EntityProto()
+      kind_pb.mutable_key().set_app('')
+      kind_pb.mutable_key().mutable_path().add_element().set_type(collection)
+      kind_pb.mutable_entity_group()
+
+      properties = self.__schema_for_kind(collection) or {}
+      for name in sorted(properties.keys()):
+        prop = kind_pb.add_property()
+        prop.set_name(name.encode('utf-8'))
+        prop.set_multiple(False)
+        for tag in properties[name]:
+          self.__fill_schema_value(tag, prop.mutable_value())
+      schema.kind_list().append(kind_pb)
 
   def _Dynamic_AllocateIds(self, allocate_ids_request, allocate_ids_response):
-    logging.log(logging.WARN, 'pre-allocating IDs unsupported')
+    kind = self.__collection_for_key(allocate_ids_request.model_key())
+    size = allocate_ids_request.size()
+    if size < 1:
+      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+                                             'Size must be positive.')
+
+    start = self.__allocate_ids(kind, size)
+    allocate_ids_response.set_start(start)
+    allocate_ids_response.set_end(start + size - 1)
 
   def __collection_and_spec_for_index(self, index):
     def translate_name(ae_name):
@@ -605,6 +3163,8 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
       return index
 
     for collection in self.__db.collection_names():
+      if _is_internal_collection(collection):
+        continue
       info = self.__db[collection].index_information()
       for index in info.keys():
         index_pb = entity_pb.CompositeIndex()
@@ -633,3 +3193,10 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
       raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
                                              "Index doesn't exist.")
     self.__db[collection].drop_index(spec)
+
+
+if __name__ == "__main__":
+  if len(sys.argv) != 3:
+    print "usage: %s APP_ID KEY_FORMAT" % sys.argv[0]
+    sys.exit(1)
+  convert_key_format(Connection()[sys.argv[1]], int(sys.argv[2]))
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+#
+# Copyright 2008-2009 10gen Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore
+from google.appengine.api import datastore_types
+from google.appengine.api import users
+from google.appengine.datastore import datastore_pb
+from google.appengine.ext import db
+from pymongo.binary import Binary
+
+import datetime
+import os
+import time
+import types
+
+print 'Content-Type: text/html'
+print ''
+print '<html><head><body>'
+
+def timed(description, function, *args):
+    start = time.time()
+    result = function(*args)
+    elapsed = time.time() - start
+    print '%s: %.3fs<br/>' % (description, elapsed)
+    return (elapsed, result)
+
+def report_speedup(slow, fast):
+    print '&nbsp;&nbsp;&nbsp;&nbsp;speedup: %.1fx<br/>' % (slow / max(fast, 0.000001))
+
+
+print '<strong>Deletes</strong><br/>'
+stub = apiproxy_stub_map.apiproxy.GetStub('datastore_v3')
+mongo_db = stub._DatastoreMongoStub__db
+
+class DeleteBenchmark(db.Model):
+    x = db.IntegerProperty()
+
+for result in DeleteBenchmark.all().fetch(1000):
+    result.delete()
+
+def ids_for_keys(keys):
+    return [stub._DatastoreMongoStub__id_for_key(key._ToPb()) for key in keys]
+
+# what Delete used to send: one unacknowledged remove per key. both sides
+# wait for the server with a getLastError at the end.
+def remove_per_key(ids):
+    for id in ids:
+        mongo_db['DeleteBenchmark'].remove({"_id": id})
+    mongo_db.error()
+
+def remove_in_one_call(ids):
+    mongo_db['DeleteBenchmark'].remove({"_id": {"$in": ids}})
+    mongo_db.error()
+
+ids = ids_for_keys(db.put([DeleteBenchmark(x=i) for i in range(500)]))
+(slow, _) = timed('Remove 500 keys, one remove per key', remove_per_key, ids)
+assert DeleteBenchmark.all().count() == 0
+
+ids = ids_for_keys(db.put([DeleteBenchmark(x=i) for i in range(500)]))
+(fast, _) = timed('Remove 500 keys with one $in remove', remove_in_one_call, ids)
+assert DeleteBenchmark.all().count() == 0
+report_speedup(slow, fast)
+
+print '<strong>Value conversion</strong><br/>'
+to_mongo = stub._DatastoreMongoStub__create_mongo_value_for_value
+
+# the chain of isinstance checks that the stub used to go through, for
+# comparison
+def isinstance_chain(value):
+    if isinstance(value, datastore_types.Rating):
+        return {'class': 'rating', 'rating': int(value)}
+    if isinstance(value, datastore_types.Category):
+        return {'class': 'category', 'category': str(value)}
+    if isinstance(value, datastore_types.Key):
+        return {'class': 'key', 'path': str(value)}
+    if isinstance(value, types.ListType):
+        sorted_list = sorted(value)
+        return {'class': 'list',
+                'list': [isinstance_chain(v) for v in value],
+                'ascending_sort_key': isinstance_chain(sorted_list[0]),
+                'descending_sort_key': isinstance_chain(sorted_list[-1])}
+    if isinstance(value, users.User):
+        return {'class': 'user', 'email': value.email()}
+    if isinstance(value, datastore_types.Text):
+        return {'class': 'text', 'string': unicode(value)}
+    if isinstance(value, datastore_types.Blob):
+        return Binary(value)
+    if isinstance(value, datastore_types.ByteString):
+        return {'class': 'bytes', 'value': Binary(value)}
+    if isinstance(value, datastore_types.IM):
+        return {'class': 'im', 'protocol': value.protocol, 'address': value.address}
+    if isinstance(value, datastore_types.GeoPt):
+        return {'class': 'geopt', 'lat': value.lat, 'lon': value.lon}
+    if isinstance(value, datastore_types.Email):
+        return {'class': 'email', 'value': value}
+    if isinstance(value, datastore_types.BlobKey):
+        return {'class': 'blobkey', 'value': value}
+    return value
+
+# one of each of the values on the Everything model in index.py
+now = datetime.datetime.now()
+everything = [u"hello", True, 10, 5.05, now, now.date(), now.time(), [1, 2, 3],
+              ["hello", u"world"], users.User("mike@example.com"),
+              db.Blob("somerandomdata"), db.Text("some random text"),
+              db.Category("awesome"), db.Link("http://www.10gen.com"),
+              db.Email("test@example.com"), db.GeoPt(40.74067, -73.99367),
+              db.IM("http://aim.com/", "example"),
+              db.PhoneNumber("1 (999) 123-4567"),
+              db.PostalAddress("40 W 20th St., New York, NY"), db.Rating(99)]
+
+def convert_all(convert):
+    for _ in range(10000):
+        for value in everything:
+            convert(value)
+
+(slow, _) = timed('Convert 10000 Everything entities with isinstance checks',
+                  convert_all, isinstance_chain)
+(fast, _) = timed('Convert 10000 Everything entities with the stub',
+                  convert_all, to_mongo)
+report_speedup(slow, fast)
+
+print '<strong>Read ahead</strong><br/>'
+class ReadAheadBenchmark(db.Model):
+    x = db.IntegerProperty()
+    text = db.TextProperty()
+
+for result in ReadAheadBenchmark.all().fetch(1000):
+    result.delete()
+db.put([ReadAheadBenchmark(x=i, text="x" * 1000) for i in range(1000)])
+
+# a separate stub with read ahead turned on, over the same database
+read_ahead_stub = stub.__class__(os.environ['APPLICATION_ID'], None,
+                                 read_ahead=True)
+
+def iterate_slowly(datastore_stub):
+    query = datastore.Query('ReadAheadBenchmark').Order('x')._ToPb()
+    result = datastore_pb.QueryResult()
+    datastore_stub.MakeSyncCall('datastore_v3', 'RunQuery', query, result)
+    seen = 0
+    while result.more_results():
+        next_request = datastore_pb.NextRequest()
+        next_request.mutable_cursor().CopyFrom(result.cursor())
+        next_request.set_count(100)
+        result = datastore_pb.QueryResult()
+        datastore_stub.MakeSyncCall('datastore_v3', 'Next', next_request, result)
+        seen += result.result_size()
+        # stand in for the app doing something with each page
+        time.sleep(0.02)
+    return seen
+
+(slow, seen) = timed('Iterate 1000 entities in pages of 100',
+                     iterate_slowly, stub)
+assert seen == 1000
+(fast, seen) = timed('Iterate 1000 entities in pages of 100, reading ahead',
+                     iterate_slowly, read_ahead_stub)
+assert seen == 1000
+report_speedup(slow, fast)
+read_ahead_stub.Close()
+
+print '<strong>Entity cache</strong><br/>'
+class CacheBenchmark(db.Model):
+    name = db.StringProperty()
+    text = db.TextProperty()
+    tags = db.StringListProperty()
+
+caching_stub = stub.__class__(os.environ['APPLICATION_ID'], None,
+                              entity_cache_size=1000000)
+key = db.put(CacheBenchmark(name="profile", text="x" * 1000,
+                            tags=["tag%d" % i for i in range(20)]))
+
+def get_repeatedly(datastore_stub):
+    request = datastore_pb.GetRequest()
+    request.add_key().CopyFrom(key._ToPb())
+    for _ in range(1000):
+        response = datastore_pb.GetResponse()
+        datastore_stub.MakeSyncCall('datastore_v3', 'Get', request, response)
+        assert response.entity(0).has_entity()
+
+(slow, _) = timed('Get one entity 1000 times', get_repeatedly, stub)
+(fast, _) = timed('Get one entity 1000 times, with the entity cache',
+                  get_repeatedly, caching_stub)
+report_speedup(slow, fast)
+db.delete(key)
+
+print '</body></html>'
@@ -18,11 +18,28 @@
 from google.appengine.api import users
 from google.appengine.ext import db
 from google.appengine.api import datastore
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import api_base_pb
+from google.appengine.api import datastore_types
+from google.appengine.datastore import datastore_pb
+from google.appengine.runtime import apiproxy_errors
 
 import datetime
+import os
+import sys
 import time
 import types
 
+def run_with_stub(datastore_stub, test):
+    """Runs test() with datastore_stub answering the datastore calls."""
+    old_apiproxy = apiproxy_stub_map.apiproxy
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', datastore_stub)
+    try:
+        test()
+    finally:
+        apiproxy_stub_map.apiproxy = old_apiproxy
+
 print 'Content-Type: text/html'
 print ''
 print '<html><head><body>'
@@ -1217,4 +1234,715 @@ model = Mutation(text=23)
 model.put()
 model.delete()
 
+print 'Test putting models of several kinds in one call...<br/>'
+for result in Person.all().fetch(1000):
+    result.delete()
+for result in Blah.all().fetch(1000):
+    result.delete()
+models = [Person(name="a"), Blah(something="b"), Person(name="c"),
+          Blah(something="d"), Person(name="e", key_name="e")]
+keys = db.put(models)
+assert [k.kind() for k in keys] == ["Person", "Blah", "Person", "Blah", "Person"]
+assert keys[4].name() == "e"
+assert [m.key() for m in models] == keys
+assert Person.all().count() == 3
+assert Blah.all().count() == 2
+fetched = db.get(keys)
+assert fetched[0].name == "a"
+assert fetched[1].something == "b"
+assert fetched[4].name == "e"
+
+print 'Test getting several models of several kinds, some missing...<br/>'
+missing = Person(name="gone")
+missing_key = missing.put()
+missing.delete()
+fetched = db.get([keys[3], missing_key, keys[0], keys[3], keys[2]])
+assert len(fetched) == 5
+assert fetched[0].something == "d"
+assert fetched[1] == None
+assert fetched[2].name == "a"
+assert fetched[3].something == "d"
+assert fetched[4].name == "c"
+
+print 'Test allocating ids...<br/>'
+class AllocateTest(db.Model):
+    x = db.IntegerProperty()
+
+first = AllocateTest(x=1).put()
+second = AllocateTest(x=2).put()
+assert first.id() > 0
+assert second.id() > first.id()
+(start, end) = db.allocate_ids(second, 10)
+assert end - start == 9
+assert start > second.id()
+third = AllocateTest(x=3).put()
+assert third.id() > second.id()
+assert not start <= third.id() <= end
+(start2, end2) = db.allocate_ids(third, 5000)
+assert end2 - start2 == 4999
+assert start2 > end
+
+print 'Test querying on a property the first entity stored does not have...<br/>'
+class SchemaTest(db.Expando):
+    pass
+
+for result in SchemaTest.all().fetch(1000):
+    result.delete()
+
+SchemaTest(a=1).put()
+SchemaTest(a=2, tags=["x", "y"]).put()
+SchemaTest(a=3, tags=["z"]).put()
+assert SchemaTest.all().filter('tags =', 'y').count() == 1
+assert SchemaTest.all().filter('tags =', 'z').get().a == 3
+assert SchemaTest.all().filter('tags >', 'x').count() == 2
+
+print "Test ancestor queries on keys that look like regular expressions...<br/>"
+for result in Ancestor.all().fetch(1000):
+    result.delete()
+
+a = Ancestor(x=20, key_name="a.b").put()
+b = Ancestor(x=21, key_name="aXb").put()
+c = Ancestor(x=22, key_name="a.bc").put()
+d = Ancestor(x=23, key_name="(a", parent=a).put()
+e = Ancestor(x=24).put()
+f = Ancestor(x=25, parent=e).put()
+
+assert Ancestor.all().ancestor(a).count() == 2
+assert Ancestor.all().ancestor(b).count() == 1
+assert Ancestor.all().ancestor(c).count() == 1
+assert Ancestor.all().ancestor(e).count() == 2
+assert Ancestor.all().ancestor(a).filter('__key__ >', a).get().x == 23
+assert Ancestor.all().ancestor(a).filter('__key__ <', d).get().x == 20
+
+print "Test that ancestor queries scan a range of the _id index...<br/>"
+stub = apiproxy_stub_map.apiproxy.GetStub('datastore_v3')
+for ancestor in [a, d, f]:
+    query = datastore.Query('Ancestor')
+    query.Ancestor(ancestor)
+    (spec, order) = stub._DatastoreMongoStub__translate_query(query._ToPb())
+    explanation = stub._DatastoreMongoStub__db['Ancestor'].find(spec).explain()
+    assert explanation['cursor'].startswith('BtreeCursor _id_')
+    assert explanation['nscanned'] <= explanation['n'] + 1
+
+print "Test that numeric ids sort numerically...<br/>"
+class IdSortTest(db.Model):
+    x = db.IntegerProperty()
+
+for result in IdSortTest.all().fetch(1000):
+    result.delete()
+
+for i in [9, 10, 100, 11, 2]:
+    IdSortTest(key=db.Key.from_path('IdSortTest', i), x=i).put()
+IdSortTest(key_name="a", x=0).put()
+
+# a database still on the first key format sorts ids as strings
+if stub._DatastoreMongoStub__key_format.version == 1:
+    key_order = [10, 100, 11, 2, 9, 0]
+else:
+    key_order = [2, 9, 10, 11, 100, 0]
+assert [a.x for a in IdSortTest.all().order('__key__')] == key_order
+key_order.reverse()
+assert [a.x for a in IdSortTest.all().order('-__key__')] == key_order
+key_order.reverse()
+ten = db.Key.from_path('IdSortTest', 10)
+assert IdSortTest.all().filter('__key__ >', ten).count() == \
+    len(key_order) - key_order.index(10) - 1
+assert IdSortTest.all().filter('__key__ <=', ten).count() == \
+    key_order.index(10) + 1
+
+print 'Test IN filters sent straight to the datastore...<br/>'
+# the SDK splits IN filters up into several queries itself, so build the
+# queries by hand to check that the stub handles them in one
+def count_query(kind, filters):
+    query = datastore_pb.Query()
+    query.set_app(os.environ['APPLICATION_ID'])
+    query.set_kind(kind)
+    for (prop, op, values) in filters:
+        filt = query.add_filter()
+        filt.set_op(op)
+        for value in values:
+            filt.add_property().CopyFrom(datastore_types.ToPropertyPb(prop, value))
+    result = api_base_pb.Integer64Proto()
+    apiproxy_stub_map.MakeSyncCall('datastore_v3', 'Count', query, result)
+    return result.value()
+
+IN = datastore_pb.Query_Filter.IN
+EQUAL = datastore_pb.Query_Filter.EQUAL
+GREATER_THAN_OR_EQUAL = datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL
+
+assert count_query('FilterTest', [('num', IN, [1, 8])]) == 4
+assert count_query('FilterTest', [('num', IN, [6])]) == 0
+assert count_query('FilterTest', [('num', IN, [10, 19, 100])]) == 2
+assert count_query('FilterTest', [('num', IN, [1, 8]),
+                                  ('num', GREATER_THAN_OR_EQUAL, [2])]) == 2
+assert count_query('FilterTest', [('num', IN, [1, 8]),
+                                  ('num', EQUAL, [8])]) == 2
+assert count_query('FilterTest', [('num', IN, [1, 8]),
+                                  ('num', EQUAL, [10])]) == 0
+assert count_query('FilterTest', [('num', IN, [1, 8, 10]),
+                                  ('num', IN, [10, 11, 1])]) == 3
+
+assert count_query('ListFilterTest', [('tags', IN, ['hello', 'of'])]) == 2
+assert count_query('ListFilterTest', [('tags', IN, ['world'])]) == 2
+assert count_query('ListFilterTest', [('tags', IN, ['goodbye'])]) == 0
+assert count_query('ListFilterTest', [('list', IN, [5, 100])]) == 3
+assert count_query('ListFilterTest', [('list', IN, [2008])]) == 0
+
+print 'Test keys only queries...<br/>'
+keys = db.Query(FilterTest, keys_only=True).filter('num >=', 10).order('num').fetch(100)
+assert len(keys) == 3
+for key in keys:
+    assert isinstance(key, db.Key)
+    assert key.kind() == 'FilterTest'
+assert [db.get(key).num for key in keys] == [10, 11, 19]
+keys = [result for result in db.GqlQuery("SELECT __key__ FROM FilterTest WHERE num = 8")]
+assert len(keys) == 2
+assert [result.num for result in db.get(keys)] == [8, 8]
+
+print 'Test projection queries...<br/>'
+# only newer SDKs can ask for projections, so this is also built by hand
+if hasattr(datastore_pb.Query, 'add_property_name'):
+    class ProjectionTest(db.Model):
+        title = db.StringProperty()
+        score = db.IntegerProperty()
+        body = db.TextProperty()
+        data = db.BlobProperty()
+
+    for result in ProjectionTest.all().fetch(1000):
+        result.delete()
+
+    ProjectionTest(title="a", score=1, body="x" * 10000, data=db.Blob("y" * 10000)).put()
+    ProjectionTest(title="b", score=2, body="z" * 10000, data=db.Blob("w" * 10000)).put()
+
+    query = datastore_pb.Query()
+    query.set_app(os.environ['APPLICATION_ID'])
+    query.set_kind('ProjectionTest')
+    query.add_property_name('title')
+    query.add_property_name('score')
+    order = query.add_order()
+    order.set_property('score')
+    result = datastore_pb.QueryResult()
+    apiproxy_stub_map.MakeSyncCall('datastore_v3', 'RunQuery', query, result)
+    next_request = datastore_pb.NextRequest()
+    next_request.mutable_cursor().CopyFrom(result.cursor())
+    next_request.set_count(10)
+    result = datastore_pb.QueryResult()
+    apiproxy_stub_map.MakeSyncCall('datastore_v3', 'Next', next_request, result)
+
+    entities = [datastore.Entity._FromPb(pb) for pb in result.result_list()]
+    assert [e['title'] for e in entities] == ['a', 'b']
+    assert [e['score'] for e in entities] == [1, 2]
+    for e in entities:
+        assert 'body' not in e
+        assert 'data' not in e
+
+print 'Test paging through query results...<br/>'
+class PageTest(db.Model):
+    n = db.IntegerProperty()
+
+for result in PageTest.all().fetch(1000):
+    result.delete()
+db.put([PageTest(n=i) for i in range(45)])
+
+def read_pages(query, count):
+    result = datastore_pb.QueryResult()
+    apiproxy_stub_map.MakeSyncCall('datastore_v3', 'RunQuery', query._ToPb(), result)
+    pages = []
+    more = result.more_results()
+    while more:
+        next_request = datastore_pb.NextRequest()
+        next_request.mutable_cursor().CopyFrom(result.cursor())
+        next_request.set_count(count)
+        result = datastore_pb.QueryResult()
+        apiproxy_stub_map.MakeSyncCall('datastore_v3', 'Next', next_request, result)
+        pages.append([datastore.Entity._FromPb(pb)['n'] for pb in result.result_list()])
+        more = result.more_results()
+    return pages
+
+pages = read_pages(datastore.Query('PageTest').Order('n'), 20)
+assert [len(page) for page in pages] == [20, 20, 5]
+assert sum(pages, []) == range(45)
+pages = read_pages(datastore.Query('PageTest', {'n >=': 40}).Order('n'), 20)
+assert pages == [[40, 41, 42, 43, 44]]
+assert [e.n for e in PageTest.all().order('n').fetch(10, 30)] == range(30, 40)
+
+print 'Test query cursors get closed...<br/>'
+stub = apiproxy_stub_map.apiproxy.GetStub('datastore_v3')
+open_cursors = stub.CursorStats()['open']
+result = datastore_pb.QueryResult()
+apiproxy_stub_map.MakeSyncCall('datastore_v3', 'RunQuery',
+                               datastore.Query('PageTest').Order('n')._ToPb(), result)
+assert stub.CursorStats()['open'] == open_cursors + 1
+next_request = datastore_pb.NextRequest()
+next_request.mutable_cursor().CopyFrom(result.cursor())
+next_request.set_count(100)
+result = datastore_pb.QueryResult()
+apiproxy_stub_map.MakeSyncCall('datastore_v3', 'Next', next_request, result)
+assert result.result_size() == 45
+assert not result.more_results()
+# the cursor was read to the end, so it's gone
+assert stub.CursorStats()['open'] == open_cursors
+try:
+    apiproxy_stub_map.MakeSyncCall('datastore_v3', 'Next', next_request,
+                                   datastore_pb.QueryResult())
+    assert False
+except apiproxy_errors.ApplicationError, e:
+    assert e.application_error == datastore_pb.Error.BAD_REQUEST
+
+print 'Test query cursors...<br/>'
+# cursors need a newer SDK too
+if hasattr(datastore_pb.Query, 'compiled_cursor'):
+    def read_page(query, count, cursor):
+        query = query._ToPb()
+        query.set_compile(True)
+        if cursor is not None:
+            query.mutable_compiled_cursor().CopyFrom(cursor)
+        result = datastore_pb.QueryResult()
+        apiproxy_stub_map.MakeSyncCall('datastore_v3', 'RunQuery', query, result)
+        next_request = datastore_pb.NextRequest()
+        next_request.mutable_cursor().CopyFrom(result.cursor())
+        next_request.set_count(count)
+        result = datastore_pb.QueryResult()
+        apiproxy_stub_map.MakeSyncCall('datastore_v3', 'Next', next_request, result)
+        return ([datastore.Entity._FromPb(pb)['n'] for pb in result.result_list()],
+                result.compiled_cursor())
+
+    cursor = None
+    pages = []
+    for _ in range(5):
+        (page, cursor) = read_page(datastore.Query('PageTest').Order('n'), 10, cursor)
+        pages.append(page)
+    assert pages == [range(0, 10), range(10, 20), range(20, 30), range(30, 40),
+                     range(40, 45)]
+
+    cursor = None
+    (page, cursor) = read_page(datastore.Query('PageTest').Order(('n', datastore.Query.DESCENDING)), 3, cursor)
+    assert page == [44, 43, 42]
+    (page, cursor) = read_page(datastore.Query('PageTest').Order(('n', datastore.Query.DESCENDING)), 3, cursor)
+    assert page == [41, 40, 39]
+
+    # a cursor only works with the sort order it came from
+    try:
+        read_page(datastore.Query('PageTest').Order('n'), 3, cursor)
+        assert False
+    except apiproxy_errors.ApplicationError, e:
+        assert e.application_error == datastore_pb.Error.BAD_REQUEST
+
+    # entities without the sort property come first, and pages can start
+    # from one of them
+    datastore.Delete([e.key() for e in datastore.Query('NullSortTest').Get(1000)])
+    for (n, name) in enumerate("abcdef"):
+        entity = datastore.Entity('NullSortTest', name=name)
+        entity['n'] = n
+        if n % 2:
+            entity['group'] = 1
+        datastore.Put(entity)
+    for (direction, expected) in [(datastore.Query.ASCENDING, [[0, 2], [4, 1], [3, 5]]),
+                                  (datastore.Query.DESCENDING, [[1, 3], [5, 0], [2, 4]])]:
+        cursor = None
+        pages = []
+        for _ in range(3):
+            (page, cursor) = read_page(datastore.Query('NullSortTest').Order(('group', direction)),
+                                       2, cursor)
+            pages.append(page)
+        assert pages == expected
+
+print 'Test counting with offsets and limits...<br/>'
+def count_pages(query, offset, limit, datastore_stub=None):
+    query = query._ToPb()
+    if offset:
+        query.set_offset(offset)
+    if limit is not None:
+        query.set_limit(limit)
+    result = api_base_pb.Integer64Proto()
+    if datastore_stub is None:
+        apiproxy_stub_map.MakeSyncCall('datastore_v3', 'Count', query, result)
+    else:
+        datastore_stub.MakeSyncCall('datastore_v3', 'Count', query, result)
+    return result.value()
+
+assert count_pages(datastore.Query('PageTest'), 0, None) == 45
+assert count_pages(datastore.Query('PageTest'), 40, None) == 5
+assert count_pages(datastore.Query('PageTest'), 10, 20) == 20
+assert count_pages(datastore.Query('PageTest'), 0, 0) == 0
+assert count_pages(datastore.Query('PageTest', {'n >=': 30}), 0, None) == 15
+assert count_pages(datastore.Query('PageTest', {'n >=': 30}), 10, 10) == 5
+assert count_pages(datastore.Query('PageTest', {'n >=': 30}), 0, 3) == 3
+assert count_pages(datastore.Query('NoSuchKind', {'n >=': 30}), 0, None) == 0
+
+print 'Test materialized counts...<br/>'
+class CountedTest(db.Model):
+    color = db.StringProperty()
+    size = db.IntegerProperty()
+    tags = db.StringListProperty()
+
+for result in CountedTest.all().fetch(1000):
+    result.delete()
+CountedTest(color="red", size=1, tags=["a", "b"]).put()
+CountedTest(color="red", size=2, tags=["a"]).put()
+
+# a stub that keeps counts, over the same database. it counts the entities
+# that are already there when it starts.
+counting_stub = stub.__class__(os.environ['APPLICATION_ID'], None,
+                               counts=[('CountedTest', ['color']),
+                                       ('CountedTest', ['color', 'size']),
+                                       ('CountedTest', ['tags'])])
+def test_counts():
+    blue = CountedTest(color="blue", size=1, tags=["b", "b", "c"])
+    blue.put()
+    red = CountedTest.all().filter('size =', 2).get()
+    red.color = "blue"
+    red.put()
+
+    def check_counts(filters, expected):
+        query = datastore.Query('CountedTest', filters)
+        assert count_pages(query, 0, None, counting_stub) == expected
+        # without counts kept, the same query comes out the same
+        assert count_pages(query, 0, None, stub) == expected
+
+    check_counts({'color =': 'red'}, 1)
+    check_counts({'color =': 'blue'}, 2)
+    check_counts({'color =': 'blue', 'size =': 1}, 1)
+    check_counts({'color =': 'blue', 'size =': 2}, 1)
+    check_counts({'tags =': 'b'}, 2)
+    check_counts({'tags =': 'c'}, 1)
+    check_counts({'tags =': 'a'}, 2)
+
+    db.delete(blue)
+    check_counts({'color =': 'blue'}, 1)
+    check_counts({'tags =': 'b'}, 1)
+    check_counts({'tags =': 'c'}, 0)
+    assert count_pages(datastore.Query('CountedTest', {'color =': 'red'}),
+                       0, 0, counting_stub) == 0
+run_with_stub(counting_stub, test_counts)
+
+# writes from a stub without the counts make them stale, so the counting stub
+# goes back to scanning (and a new one rebuilds them). the plain stub only
+# notices counts built since it last looked after a little while.
+time.sleep(sys.modules[stub.__class__.__module__]._BUILT_COUNTS_TTL)
+CountedTest(color="red", size=3, tags=[]).put()
+query = datastore.Query('CountedTest', {'color =': 'red'})
+assert count_pages(query, 0, None, counting_stub) == 2
+counting_stub = stub.__class__(os.environ['APPLICATION_ID'], None,
+                               counts=[('CountedTest', ['color'])])
+assert count_pages(query, 0, None, counting_stub) == 2
+
+print 'Test the entity cache...<br/>'
+class CachedTest(db.Model):
+    name = db.StringProperty()
+    when = db.DateTimeProperty()
+
+class UncachedTest(db.Model):
+    name = db.StringProperty()
+
+caching_stub = stub.__class__(os.environ['APPLICATION_ID'], None,
+                              entity_cache_size=1000000,
+                              uncached_kinds=['UncachedTest'])
+def test_entity_cache():
+    now = datetime.datetime.now()
+    key = CachedTest(name="first", when=now).put()
+    uncached_key = UncachedTest(name="first").put()
+    assert caching_stub.CacheStats()['entities']['entries'] == 0
+
+    assert CachedTest.get(key).name == "first"
+    assert caching_stub.CacheStats()['entities']['misses'] == 1
+    for _ in range(3):
+        entity = CachedTest.get(key)
+        assert entity.name == "first"
+        assert entity.when == CachedTest.get(key).when
+    assert [e.name for e in CachedTest.get([key, key])] == ["first", "first"]
+    assert caching_stub.CacheStats()['entities']['hits'] == 7
+    assert caching_stub.CacheStats()['entities']['entries'] == 1
+
+    assert UncachedTest.get(uncached_key).name == "first"
+    assert caching_stub.CacheStats()['entities']['entries'] == 1
+
+    # writes go through the cache
+    entity = CachedTest.get(key)
+    entity.name = "second"
+    entity.put()
+    assert CachedTest.get(key).name == "second"
+    db.delete(key)
+    assert CachedTest.get(key) is None
+    assert CachedTest.get([key, key]) == [None, None]
+    assert caching_stub.CacheStats()['entities']['entries'] == 0
+    db.delete(uncached_key)
+run_with_stub(caching_stub, test_entity_cache)
+
+print 'Test cache invalidation between stubs...<br/>'
+stub_module = sys.modules[stub.__class__.__module__]
+
+def get_name(datastore_stub, key):
+    request = datastore_pb.GetRequest()
+    request.add_key().CopyFrom(key._ToPb())
+    response = datastore_pb.GetResponse()
+    datastore_stub.MakeSyncCall('datastore_v3', 'Get', request, response)
+    return datastore.Entity._FromPb(response.entity(0).entity())['name']
+
+def put_name(datastore_stub, key, name):
+    entity = datastore.Get(key)
+    entity['name'] = name
+    request = datastore_pb.PutRequest()
+    request.add_entity().CopyFrom(entity._ToPb())
+    datastore_stub.MakeSyncCall('datastore_v3', 'Put', request,
+                                datastore_pb.PutResponse())
+
+key = CachedTest(name="first").put()
+# stand ins for stubs in two different processes
+bus = stub_module.MemoryInvalidationBus()
+first = stub.__class__(os.environ['APPLICATION_ID'], None,
+                       entity_cache_size=1000000, invalidation_bus=bus)
+second = stub.__class__(os.environ['APPLICATION_ID'], None,
+                        entity_cache_size=1000000, invalidation_bus=bus)
+assert get_name(first, key) == "first"
+assert get_name(second, key) == "first"
+put_name(second, key, "second")
+assert get_name(second, key) == "second"
+assert get_name(first, key) == "second"
+
+# without the bus the other stub keeps serving what it cached
+unconnected = stub.__class__(os.environ['APPLICATION_ID'], None,
+                             entity_cache_size=1000000)
+assert get_name(unconnected, key) == "second"
+put_name(first, key, "third")
+assert get_name(second, key) == "third"
+assert get_name(unconnected, key) == "second"
+db.delete(key)
+
+print 'Test the query cache...<br/>'
+class LeaderboardTest(db.Model):
+    name = db.StringProperty()
+    score = db.IntegerProperty()
+
+for result in LeaderboardTest.all().fetch(1000):
+    result.delete()
+db.put([LeaderboardTest(name="player%d" % i, score=i) for i in range(10)])
+
+query_caching_stub = stub.__class__(os.environ['APPLICATION_ID'], None,
+                                    query_cache_size=1000000)
+def test_query_cache():
+    def top_three():
+        return [e.name for e in LeaderboardTest.all().order('-score').fetch(3)]
+
+    for _ in range(4):
+        assert top_three() == ["player9", "player8", "player7"]
+    [top_shape] = [shape for shape in query_caching_stub.QueryCacheStats().keys()
+                   if shape[0] == 'LeaderboardTest']
+    shape_stats = query_caching_stub.QueryCacheStats()[top_shape]
+    assert shape_stats['hits'] == 3
+    assert shape_stats['misses'] == 1
+
+    # writing to the kind invalidates its cached results
+    LeaderboardTest(name="newcomer", score=100).put()
+    assert top_three() == ["newcomer", "player9", "player8"]
+    assert query_caching_stub.QueryCacheStats()[top_shape]['misses'] == 2
+    db.delete(LeaderboardTest.all().filter('name =', 'newcomer').fetch(1))
+    assert top_three() == ["player9", "player8", "player7"]
+
+    # and writing to another kind doesn't
+    CountTest(prop="unrelated").put()
+    assert top_three() == ["player9", "player8", "player7"]
+    assert query_caching_stub.QueryCacheStats()[top_shape]['hits'] == 4
+
+    # keys only queries are cached apart from full ones
+    keys = db.Query(LeaderboardTest, keys_only=True).order('-score').fetch(3)
+    assert [db.get(key).name for key in keys] == ["player9", "player8", "player7"]
+run_with_stub(query_caching_stub, test_query_cache)
+
+print 'Test request scopes...<br/>'
+key = CachedTest(name="first").put()
+missing_key = db.Key.from_path('CachedTest', 'no such entity')
+stub.BeginRequest()
+try:
+    assert CachedTest.get(key).name == "first"
+    assert CachedTest.get(missing_key) is None
+    # change the entity behind the stub's back. the scope keeps answering
+    # with what the request saw first
+    stub._DatastoreMongoStub__db['CachedTest'].update({}, {"$set": {"name": "changed"}},
+                                                      multi=True)
+    assert CachedTest.get(key).name == "first"
+    assert [e.name for e in CachedTest.get([key, key])] == ["first", "first"]
+    assert CachedTest.get(missing_key) is None
+
+    # but the request's own writes show through
+    entity = CachedTest.get(key)
+    entity.name = "second"
+    entity.put()
+    assert CachedTest.get(key).name == "second"
+    CachedTest(key_name='no such entity', name="found").put()
+    assert CachedTest.get(missing_key).name == "found"
+    db.delete(missing_key)
+    assert CachedTest.get(missing_key) is None
+finally:
+    stub.EndRequest()
+
+stub._DatastoreMongoStub__db['CachedTest'].update({}, {"$set": {"name": "changed"}},
+                                                  multi=True)
+assert CachedTest.get(key).name == "changed"
+db.delete(key)
+
+print 'Test writing behind...<br/>'
+class LogTest(db.Model):
+    message = db.StringProperty()
+
+for result in LogTest.all().fetch(1000):
+    result.delete()
+
+# the background thread won't get to anything during the test
+writing_behind_stub = stub.__class__(os.environ['APPLICATION_ID'], None,
+                                     write_behind_kinds=['LogTest'],
+                                     write_behind_size=5,
+                                     write_behind_interval=3600)
+mongo_logs = stub._DatastoreMongoStub__db['LogTest']
+def test_writing_behind():
+    key = LogTest(message="hello").put()
+    assert key.id()
+    assert mongo_logs.count() == 0
+    # reads see the held write
+    assert LogTest.get(key).message == "hello"
+    assert mongo_logs.count() == 1
+
+    LogTest(message="one").put()
+    LogTest(message="two").put()
+    assert mongo_logs.count() == 1
+    assert LogTest.all().count() == 3
+    assert sorted([e.message for e in LogTest.all()]) == ["hello", "one", "two"]
+
+    # putting the same entity twice only writes the last version
+    entity = LogTest(message="first")
+    entity.put()
+    entity.message = "second"
+    entity.put()
+    db.delete(entity)
+    assert LogTest.get(entity.key()) is None
+
+    # once enough are held, Put writes them itself
+    db.put([LogTest(message="batch %d" % i) for i in range(4)])
+    assert mongo_logs.count() == 3
+    LogTest(message="last").put()
+    assert mongo_logs.count() == 8
+
+    LogTest(message="flushed").put()
+    writing_behind_stub.Flush()
+    assert mongo_logs.count() == 9
+
+    # closing the stub stops its thread and writes out what it still holds
+    LogTest(message="closing").put()
+    assert mongo_logs.count() == 9
+    writing_behind_stub.Close()
+    assert mongo_logs.count() == 10
+run_with_stub(writing_behind_stub, test_writing_behind)
+
+print 'Test registering a value type...<br/>'
+class LinkTest(db.Model):
+    link = db.LinkProperty()
+    links = db.ListProperty(db.Link)
+
+link_stub = stub.__class__(os.environ['APPLICATION_ID'], None)
+link_stub.RegisterValueType(datastore_types.Link, 'link',
+                            lambda value: {'url': unicode(value)},
+                            lambda mongo_value: db.Link(mongo_value['url']))
+def test_value_type():
+    db.delete(LinkTest.all().fetch(1000))
+    LinkTest(link=db.Link("http://a.example.com/"),
+             links=[db.Link("http://b.example.com/")]).put()
+    LinkTest(link=db.Link("http://c.example.com/"), links=[]).put()
+
+    stored = stub._DatastoreMongoStub__db['LinkTest'].find_one(
+        {'link.url': u"http://a.example.com/"})
+    assert stored['link'] == {'class': 'link', 'url': u"http://a.example.com/"}
+
+    # single values and filters go through the registered converters too
+    entity = LinkTest.all().filter('link =', db.Link("http://a.example.com/")).get()
+    assert entity.link == "http://a.example.com/"
+    assert type(entity.link) is db.Link
+    assert entity.links == [db.Link("http://b.example.com/")]
+    assert LinkTest.all().filter('links =', db.Link("http://b.example.com/")).count() == 1
+    assert [e.link for e in LinkTest.all().order('link')] == \
+        ["http://a.example.com/", "http://c.example.com/"]
+    db.delete(LinkTest.all().fetch(1000))
+run_with_stub(link_stub, test_value_type)
+
+print 'Test reading query results ahead...<br/>'
+class ReadAheadTest(db.Model):
+    n = db.IntegerProperty()
+
+db.delete(ReadAheadTest.all().fetch(1000))
+db.put([ReadAheadTest(n=i) for i in range(100)])
+
+read_ahead_stub = stub.__class__(os.environ['APPLICATION_ID'], None,
+                                 read_ahead=True, read_ahead_results=30,
+                                 read_ahead_total=50, max_open_cursors=2)
+open_queries = read_ahead_stub._DatastoreMongoStub__queries
+
+def wait_for_read_ahead():
+    for _ in range(500):
+        if not [q for q in open_queries.values() if q.read_ahead_pending]:
+            break
+        time.sleep(0.01)
+    # the worker holds the lock while it reads
+    for open_query in open_queries.values():
+        open_query.lock.acquire()
+        open_query.lock.release()
+
+def test_read_ahead():
+    query = datastore.Query('ReadAheadTest').Order('n')
+
+    # results come out complete and in order
+    pages = read_pages(query, 15)
+    assert sum(pages, []) == range(100)
+
+    # no cursor buffers more than read_ahead_results, and all of them
+    # together no more than read_ahead_total
+    result = datastore_pb.QueryResult()
+    apiproxy_stub_map.MakeSyncCall('datastore_v3', 'RunQuery', query._ToPb(), result)
+    next_request = datastore_pb.NextRequest()
+    next_request.mutable_cursor().CopyFrom(result.cursor())
+    next_request.set_count(40)
+    apiproxy_stub_map.MakeSyncCall('datastore_v3', 'Next', next_request,
+                                   datastore_pb.QueryResult())
+    wait_for_read_ahead()
+    [first] = open_queries.values()
+    assert len(first.buffered) == 30
+
+    result = datastore_pb.QueryResult()
+    apiproxy_stub_map.MakeSyncCall('datastore_v3', 'RunQuery', query._ToPb(), result)
+    next_request.mutable_cursor().CopyFrom(result.cursor())
+    apiproxy_stub_map.MakeSyncCall('datastore_v3', 'Next', next_request,
+                                   datastore_pb.QueryResult())
+    wait_for_read_ahead()
+    assert sorted([len(q.buffered) for q in open_queries.values()]) == [20, 30]
+
+    # a third cursor pushes out the least recently used one, which lets go
+    # of what it read ahead
+    pages = read_pages(query, 40)
+    assert sum(pages, []) == range(100)
+    assert first.closed
+    assert first.buffered == []
+    assert read_ahead_stub.CursorStats()['evictions'] == 1
+run_with_stub(read_ahead_stub, test_read_ahead)
+
+read_ahead_stub.Close()
+assert read_ahead_stub.CursorStats()['open'] == 0
+db.delete(ReadAheadTest.all().fetch(1000))
+
+print 'Test mixing explicit ids with allocated ones...<br/>'
+class MixedIdTest(db.Model):
+    x = db.IntegerProperty()
+
+db.delete(MixedIdTest.all().fetch(1000))
+# the next ids this process hands out come straight after an allocated one,
+# so store entities under them first
+(start, end) = db.allocate_ids(db.Key.from_path('MixedIdTest', 1), 1)
+explicit = [MixedIdTest(key=db.Key.from_path('MixedIdTest', end + i), x=-i)
+            for i in range(1, 4)]
+db.put(explicit)
+allocated = db.put([MixedIdTest(x=i) for i in range(1, 4)])
+assert len(set([key.id() for key in allocated])) == 3
+assert not set([key.id() for key in allocated]) & set([e.key().id() for e in explicit])
+assert [e.x for e in MixedIdTest.get([e.key() for e in explicit])] == [-1, -2, -3]
+assert [e.x for e in MixedIdTest.get(allocated)] == [1, 2, 3]
+assert MixedIdTest.all().count() == 6
+db.delete(MixedIdTest.all().fetch(1000))
+
 print '</body></html>'